@@ -0,0 +1,117 @@
+"""
+内存基准：1000 个群 × chat_max_log 条记录占用的内存。
+
+    python benchmarks/bench_memory.py --groups 1000 --records 60
+    python benchmarks/bench_memory.py --image-bytes 30000 --reload
+
+--image-bytes 以给定大小的 base64 data URL 代替图片链接（模拟 base64 模式），
+--reload 统计经 YAML 持久化再加载后的内存（即重启后的情况）。
+"""
+
+import gc
+import time
+import yaml
+import random
+import argparse
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+from common import load_plugin
+
+
+def image(rng: random.Random, size: int) -> str:
+    if size <= 0:
+        token = "".join(rng.choices("0123456789abcdef", k=32))
+        return (
+            "https://multimedia.nt.qq.com.cn/download?appid=1407&fileid="
+            + token
+            + "&spec=0&rkey=CAQSKAB6JWENi5LMtWVWVxS2RmTP"
+        )
+    return "data:image/jpeg;base64," + "".join(rng.choices("ABCDEFGH", k=size))
+
+
+def build(RecordSeg, RecordList, args, rng: random.Random) -> list:
+    start = datetime.now() - timedelta(days=1)
+    groups = []
+    for g in range(args.groups):
+        msgs = RecordList()
+        users = [(f"群友{g}_{u}", 10000 + u) for u in range(args.users)]
+        for i in range(args.records):
+            name, uid = rng.choice(users)
+            images = [image(rng, args.image_bytes)] if rng.random() < 0.2 else []
+            reply = None
+            if i and rng.random() < 0.1:
+                # 引用的消息由事件重新构造，名字与 ID 都是新的字符串对象
+                qname, quid = rng.choice(users)
+                reply = RecordSeg(
+                    "".join(qname),
+                    str(quid),
+                    f"<p>被引用的第 {i - 1} 条</p>",
+                    i - 1,
+                    start,
+                    images=[image(rng, args.image_bytes)],
+                )
+            msgs.add(
+                RecordSeg(
+                    "".join(name),
+                    str(uid),
+                    f'<p msgid="{i}">第 {i} 条消息，随便说点什么</p>',
+                    i,
+                    start + timedelta(seconds=i * 30),
+                    images=images,
+                    reply=reply,
+                )
+            )
+        groups.append(msgs)
+    return groups
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--records", type=int, default=0, help="默认为 chat_max_log")
+    parser.add_argument("--users", type=int, default=30, help="每个群的活跃用户数")
+    parser.add_argument("--image-bytes", type=int, default=0)
+    parser.add_argument("--reload", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_plugin()
+    from nonebot_plugin_chatgpt_vision.config import p_config
+    from nonebot_plugin_chatgpt_vision.record import RecordSeg, RecordList
+
+    if not args.records:
+        args.records = p_config.chat_max_log
+    rng = random.Random(args.seed)
+
+    if args.reload:
+        dumper = getattr(yaml, "CDumper", yaml.Dumper)
+        loader = getattr(yaml, "CUnsafeLoader", yaml.UnsafeLoader)
+        dumped = yaml.dump(
+            build(RecordSeg, RecordList, args, rng), allow_unicode=True, Dumper=dumper
+        )
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    if args.reload:
+        groups = yaml.load(dumped, Loader=loader)
+    else:
+        groups = build(RecordSeg, RecordList, args, rng)
+    gc.collect()
+    elapsed = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    used = current
+    records = sum(len(g) for g in groups)
+    print(
+        f"{args.groups} 个群，共 {records} 条记录"
+        + ("（YAML 重新加载）" if args.reload else "")
+    )
+    print(f"占用 {used / 2**20:.1f} MiB，每条记录 {used / records:.0f} B")
+    print(f"峰值 {peak / 2**20:.1f} MiB，耗时 {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+微基准：RecordList.message 在满窗口下的渲染耗时。
+
+    python benchmarks/bench_render.py --records 60 --iterations 2000
+
+cold   每次调用前使所有记录的缓存失效，相当于不带缓存的渲染
+warm   窗口未变化时重复渲染（例如工具调用的递归轮次）
+steady 每轮追加一条消息并淘汰最旧的一条后渲染（正常的 say）
+"""
+
+import time
+import random
+import argparse
+
+from datetime import datetime, timedelta
+
+from common import load_plugin
+
+BOT_ID = "100000"
+
+
+def build_window(
+    RecordSeg, RecordKind, n: int, rng: random.Random, start: datetime
+) -> list:
+    records = []
+    for i in range(n):
+        when = start + timedelta(seconds=i)
+        kind = rng.random()
+        if kind < 0.15:
+            bot = RecordSeg(
+                "苦咖啡",
+                BOT_ID,
+                "<p>我查一下</p>",
+                "content",
+                when,
+                kind=RecordKind.TOOL_CALLS,
+                tool_calls=[
+                    {
+                        "function": {"name": "list_blocked_users", "arguments": "{}"},
+                        "id": f"call_{i}",
+                        "type": "function",
+                    }
+                ],
+            )
+            records.append(bot)
+            records.append(
+                RecordSeg("list_blocked_users", "tool", "[]", f"call_{i}", when)
+            )
+        elif kind < 0.3:
+            records.append(
+                RecordSeg(
+                    "苦咖啡",
+                    BOT_ID,
+                    "<p>笑死</p><p>确实</p>",
+                    "content",
+                    when,
+                    kind=RecordKind.ASSISTANT,
+                )
+            )
+        else:
+            uid = rng.randrange(5)
+            reply = None
+            if rng.random() < 0.2:
+                reply = RecordSeg(
+                    f"用户{uid + 1}",
+                    str(10001 + uid),
+                    "<p>被引用的消息</p>",
+                    i - 1,
+                    when,
+                )
+            images = [f"https://example.com/{i}.png"] if rng.random() < 0.2 else []
+            records.append(
+                RecordSeg(
+                    f"用户{uid}",
+                    str(10000 + uid),
+                    f'<p msgid="{i}">这是第 {i} 条消息，<mention uid="{BOT_ID}">@苦咖啡</mention> 说点什么</p>',
+                    i,
+                    when,
+                    images=images,
+                    reply=reply,
+                )
+            )
+    return records
+
+
+def bench(func, iterations: int) -> float:
+    func()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--records", type=int, default=60)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--image-mode", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    load_plugin()
+    from nonebot_plugin_chatgpt_vision.record import RecordSeg, RecordKind, RecordList
+
+    rng = random.Random(args.seed)
+    start = datetime.now() - timedelta(days=1)
+    msgs = RecordList(merge=False)
+    msgs.extend(build_window(RecordSeg, RecordKind, args.records, rng, start))
+    extra = iter(
+        build_window(RecordSeg, RecordKind, args.iterations * 4, rng, datetime.now())
+    )
+
+    def cold():
+        for r in msgs.records:
+            r.touch()
+        msgs.message(BOT_ID, args.image_mode)
+
+    def warm():
+        msgs.message(BOT_ID, args.image_mode)
+
+    def steady():
+        msgs.add(next(extra))
+        while len(msgs) > args.records:
+            msgs.remove(0)
+        msgs.message(BOT_ID, args.image_mode)
+
+    results = {
+        name: bench(func, args.iterations)
+        for name, func in (("cold", cold), ("warm", warm), ("steady", steady))
+    }
+    print(f"窗口 {len(msgs)} 条记录，每项 {args.iterations} 次")
+    for name, t in results.items():
+        print(
+            f"{name:<8}{t * 1e6:>10.1f} us/次"
+            + (f"  {results['cold'] / t:>6.1f}x" if name != "cold" else "")
+        )
+
+
+if __name__ == "__main__":
+    main()
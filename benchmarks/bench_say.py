@@ -0,0 +1,283 @@
+"""
+端到端压测 GroupRecord.append / say。
+
+启动本地桩服务器（见 stub_server.py），把 OPENAI_CONFIG 指向它，
+并发驱动 N 个群的对话，统计吞吐、首段耗时分位数与各阶段的 CPU 耗时。
+
+    python benchmarks/bench_say.py --groups 50 --rounds 5 --history 40 --stream
+
+加 --json 输出机器可读的结果，便于与基线比较。
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import threading
+import functools
+
+from datetime import datetime, timedelta
+
+from common import load_plugin, percentile
+from stub_server import StubConfig, StubServer
+
+MODEL = "stub"
+
+NAMES = ["张三", "李四", "王五", "赵六", "钱七"]
+TEXTS = [
+    "今天吃什么",
+    "有没有人打游戏",
+    "这个题怎么做啊，求个思路",
+    "笑死我了",
+    "刚下班，累死",
+    "明天会下雨吗",
+    "有人看昨天的比赛吗，最后那个球太离谱了",
+    "我觉得这个方案不太行，成本太高了，而且维护起来也麻烦",
+]
+
+
+class Stages:
+    """统计各阶段的 CPU 时间（线程 CPU 时间，兼容 to_thread 中的调用）"""
+
+    def __init__(self):
+        self.cpu: dict[str, float] = {}
+        self.calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def add(self, name: str, cpu: float):
+        with self.lock:
+            self.cpu[name] = self.cpu.get(name, 0.0) + cpu
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def timed(self, name: str, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.thread_time() - start)
+
+        return wrapper
+
+    def patch(self, owner, attr: str, name: str):
+        setattr(owner, attr, self.timed(name, getattr(owner, attr)))
+
+    def report(self) -> dict[str, dict[str, float]]:
+        return {
+            name: {
+                "cpu": self.cpu[name],
+                "calls": self.calls[name],
+                "per_call_us": self.cpu[name] / self.calls[name] * 1e6,
+            }
+            for name in sorted(self.cpu, key=lambda k: -self.cpu[k])
+        }
+
+
+def make_record(RecordSeg, rng: random.Random, index: int, when: datetime):
+    uid = rng.randrange(len(NAMES))
+    text = rng.choice(TEXTS)
+    if rng.random() < 0.2:
+        text = f'<mention uid="100000">@苦咖啡</mention> {text}'
+    return RecordSeg(
+        NAMES[uid],
+        str(10000 + uid),
+        f"<p>{text}</p>",
+        index,
+        when,
+    )
+
+
+async def run(args) -> dict:
+    load_plugin(
+        fallback_model=MODEL,
+        chat_stream=args.stream,
+        hedge_enabled=args.hedge,
+    )
+
+    from nonebot_plugin_chatgpt_vision import chat as chat_module
+    from nonebot_plugin_chatgpt_vision import group as group_module
+    from nonebot_plugin_chatgpt_vision.utils import ParagraphStream
+    from nonebot_plugin_chatgpt_vision.record import (
+        RecordSeg,
+        RecordList,
+        xml_to_v11msg,
+    )
+
+    stages = Stages()
+    stages.patch(group_module.GroupRecord, "merge", "merge")
+    stages.patch(RecordList, "message", "merge.message")
+    stages.patch(RecordList, "add", "append.add")
+    stages.patch(RecordList, "tokens", "tokens")
+    stages.patch(group_module, "fix_xml", "fix_xml")
+    stages.patch(ParagraphStream, "feed", "paragraph_split")
+
+    @functools.partial(stages.timed, "xml_to_v11msg")
+    def to_v11(xml: str):
+        # 与 human_like 发送时的处理一致
+        if not xml.strip():
+            return
+        try:
+            list(xml_to_v11msg(xml))
+        except ValueError:
+            pass
+
+    stub = StubServer(
+        StubConfig(
+            latency=args.latency,
+            jitter=args.jitter,
+            tps=args.tps,
+            tool_rate=args.tool_rate,
+            error_rate=args.error_rate,
+            seed=args.seed,
+        )
+    )
+    async with stub:
+        base_url = args.stub_url or stub.base_url
+        chat_module.OPENAI_CONFIG[MODEL] = [
+            {
+                "api_key": "stub",
+                "base_url": base_url,
+                "max_connections": max(100, args.groups * 2),
+            }
+        ]
+
+        rng = random.Random(args.seed)
+        start_time = datetime.now() - timedelta(hours=1)
+        groups = [
+            group_module.GroupRecord(
+                group_id=str(i),
+                model=MODEL,
+                stream=args.stream,
+                max_logs=args.max_logs,
+                max_tokens=args.max_tokens,
+                default_tools=["list_blocked_users"],
+            )
+            for i in range(args.groups)
+        ]
+        for g in groups:
+            for j in range(args.history):
+                await g.append(
+                    make_record(RecordSeg, rng, j, start_time + timedelta(seconds=j))
+                )
+
+        ttfp: list[float] = []
+        totals: list[float] = []
+        replies = 0
+        paragraphs = 0
+
+        async def drive(g, gid: int):
+            nonlocal replies, paragraphs
+            for r in range(args.rounds):
+                await g.append(
+                    make_record(RecordSeg, rng, args.history + r + 1, datetime.now())
+                )
+                started = time.perf_counter()
+                first = None
+                async for p in g.say(hedge=args.hedge):
+                    if first is None and p.strip():
+                        first = time.perf_counter() - started
+                    paragraphs += 1
+                    to_v11(p)
+                totals.append(time.perf_counter() - started)
+                if first is not None:
+                    ttfp.append(first)
+                    replies += 1
+
+        # 预热：建立连接、加载分词器等一次性开销不计入结果
+        warmup = group_module.GroupRecord(model=MODEL, default_tools=[])
+        await warmup.append(make_record(RecordSeg, rng, 0, datetime.now()))
+        async for _ in warmup.say():
+            pass
+        stages.cpu.clear()
+        stages.calls.clear()
+        stub.stats.update(requests=0, errors=0, tool_calls=0)
+
+        cpu_start = time.process_time()
+        wall_start = time.perf_counter()
+        await asyncio.gather(*[drive(g, i) for i, g in enumerate(groups)])
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        stub_stats = dict(stub.stats)
+
+    says = args.groups * args.rounds
+    return {
+        "config": vars(args),
+        "says": says,
+        "replies": replies,
+        "paragraphs": paragraphs,
+        "wall": wall,
+        "throughput": says / wall,
+        "ttfp": {
+            "p50": percentile(ttfp, 0.5),
+            "p95": percentile(ttfp, 0.95),
+            "p99": percentile(ttfp, 0.99),
+        },
+        "say": {
+            "p50": percentile(totals, 0.5),
+            "p95": percentile(totals, 0.95),
+            "p99": percentile(totals, 0.99),
+        },
+        "process_cpu": cpu,
+        "stages": stages.report(),
+        "stub": stub_stats,
+    }
+
+
+def print_report(result: dict):
+    print(
+        f"say 调用 {result['says']} 次，有回复 {result['replies']} 次，"
+        f"段落 {result['paragraphs']} 个，耗时 {result['wall']:.2f}s，"
+        f"吞吐 {result['throughput']:.1f} say/s"
+    )
+    for key, title in (("ttfp", "首段耗时"), ("say", "say 总耗时")):
+        q = result[key]
+        print(
+            f"{title}: p50 {q['p50'] * 1000:.1f}ms  "
+            f"p95 {q['p95'] * 1000:.1f}ms  p99 {q['p99'] * 1000:.1f}ms"
+        )
+    print(
+        f"进程 CPU 时间 {result['process_cpu']:.3f}s"
+        + ("（含进程内桩服务器）" if not result["config"]["stub_url"] else "")
+    )
+    print(f"{'阶段':<20}{'CPU(s)':>10}{'次数':>10}{'每次(us)':>12}")
+    for name, s in result["stages"].items():
+        print(f"{name:<20}{s['cpu']:>10.3f}{s['calls']:>10}{s['per_call_us']:>12.1f}")
+    print(f"桩服务器: {result['stub']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument(
+        "--history", type=int, default=30, help="每个群预先写入的消息数"
+    )
+    parser.add_argument("--max-logs", type=int, default=50)
+    parser.add_argument("--max-tokens", type=int, default=0)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--hedge", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--tps", type=float, default=200)
+    parser.add_argument("--tool-rate", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--stub-url", default="", help="使用外部桩服务器，避免其 CPU 计入本进程"
+    )
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.json:
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""压测脚本共用的工具"""
+
+import os
+import tempfile
+
+
+def load_plugin(**config):
+    """
+    在临时工作目录中初始化 NoneBot 并加载插件
+
+    插件会在工作目录下读写 data/ 与 configs/，切到临时目录避免污染
+    """
+    import nonebot
+
+    os.chdir(tempfile.mkdtemp(prefix="chatgpt-vision-bench-"))
+    os.makedirs("data", exist_ok=True)
+    config.setdefault("driver", "~none")
+    config.setdefault("metrics_path", "")
+    nonebot.init(**config)
+    nonebot.load_plugin("nonebot_plugin_chatgpt_vision")
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
@@ -0,0 +1,250 @@
+"""
+本地 OpenAI 兼容的桩服务器，用于在不请求真实服务商的情况下压测插件。
+
+支持可配置的首包延迟、token 生成速度、预设的 XML 回复、工具调用与错误注入。
+
+单独运行：
+
+    python benchmarks/stub_server.py --port 8787 --latency 0.3 --tps 80
+
+然后在 keys.yaml 中把模型的 url 指向 http://127.0.0.1:8787/v1 即可。
+"""
+
+import json
+import time
+import random
+import asyncio
+import argparse
+import uvicorn
+
+from dataclasses import dataclass, field
+from starlette.routing import Route
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.applications import Starlette
+
+DEFAULT_REPLIES = [
+    "<p>在吗</p>",
+    '<p><reply id="1"/>确实是这样的</p><p>不过我觉得还可以再想想</p>',
+    '<p>笑死</p><p><face id="178" name="斜眼笑"/></p>',
+    "<p>这题我会<br/>先把两边平方</p><p>然后移项就行了</p><p>就这？</p>",
+    "[NULL]",
+    '<p><code lang="markdown"><![CDATA[# 结论\n\n$$E=mc^2$$\n\n</p> 也不会被截断]]></code></p><p>懂了吗</p>',
+]
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.3
+    """首包延迟（秒）"""
+    jitter: float = 0.1
+    """首包延迟的随机抖动（秒）"""
+    tps: float = 80
+    """生成速度（token/秒），0 表示不限速"""
+    replies: list[str] = field(default_factory=lambda: list(DEFAULT_REPLIES))
+    """随机选取的 XML 回复"""
+    tool_rate: float = 0.0
+    """带 tools 的请求返回工具调用的概率"""
+    tool_name: str = "list_blocked_users"
+    error_rate: float = 0.0
+    """返回错误的概率"""
+    error_codes: tuple[int, ...] = (429, 500, 503)
+    seed: int | None = None
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // 2)
+
+
+def create_app(config: StubConfig) -> Starlette:
+    rng = random.Random(config.seed)
+    stats = {"requests": 0, "errors": 0, "tool_calls": 0}
+
+    async def completions(request: Request):
+        body = await request.json()
+        stats["requests"] += 1
+        model = body.get("model", "stub")
+        messages = body.get("messages", [])
+        stream = bool(body.get("stream"))
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        await asyncio.sleep(max(0.0, config.latency + rng.uniform(0, config.jitter)))
+        if rng.random() < config.error_rate:
+            stats["errors"] += 1
+            code = rng.choice(config.error_codes)
+            headers = {"Retry-After": "1"} if code == 429 else {}
+            return JSONResponse(
+                {"error": {"message": f"injected {code}", "type": "stub_error"}},
+                status_code=code,
+                headers=headers,
+            )
+
+        prompt_tokens = _tokens(json.dumps(messages, ensure_ascii=False))
+        last_role = messages[-1].get("role") if messages else None
+        tool_call = None
+        if (
+            body.get("tools")
+            and last_role != "tool"
+            and rng.random() < config.tool_rate
+        ):
+            stats["tool_calls"] += 1
+            tool_call = {
+                "id": f"call_{stats['requests']}",
+                "type": "function",
+                "function": {"name": config.tool_name, "arguments": "{}"},
+            }
+        content = "" if tool_call else rng.choice(config.replies)
+        completion_tokens = _tokens(content) if content else 8
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+        rid = f"chatcmpl-stub-{stats['requests']}"
+        created = int(time.time())
+
+        if not stream:
+            message: dict = {"role": "assistant", "content": content or None}
+            if tool_call:
+                message["tool_calls"] = [tool_call]
+            return JSONResponse(
+                {
+                    "id": rid,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": message,
+                            "finish_reason": "tool_calls" if tool_call else "stop",
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+
+        def chunk(delta: dict, finish: str | None = None, **extra) -> str:
+            data = {
+                "id": rid,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": (
+                    []
+                    if delta is None
+                    else [{"index": 0, "delta": delta, "finish_reason": finish}]
+                ),
+                **extra,
+            }
+            return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+        async def events():
+            yield chunk({"role": "assistant", "content": ""})
+            if tool_call:
+                yield chunk(
+                    {
+                        "tool_calls": [
+                            {
+                                "index": 0,
+                                "id": tool_call["id"],
+                                "type": "function",
+                                "function": {"name": tool_call["function"]["name"]},
+                            }
+                        ]
+                    }
+                )
+                yield chunk(
+                    {"tool_calls": [{"index": 0, "function": {"arguments": "{}"}}]}
+                )
+            # 每个分片约 4 个字符，按 tps 限速
+            step = 4
+            for i in range(0, len(content), step):
+                piece = content[i : i + step]
+                if config.tps > 0:
+                    await asyncio.sleep(_tokens(piece) / config.tps)
+                yield chunk({"content": piece})
+            yield chunk({}, "tool_calls" if tool_call else "stop")
+            if include_usage:
+                yield chunk(None, usage=usage)  # type: ignore[arg-type]
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def get_stats(request: Request):
+        return JSONResponse(stats)
+
+    app = Starlette(
+        routes=[
+            Route("/v1/chat/completions", completions, methods=["POST"]),
+            Route("/stats", get_stats, methods=["GET"]),
+        ]
+    )
+    app.state.stats = stats
+    return app
+
+
+class StubServer:
+    """在当前事件循环中运行桩服务器"""
+
+    def __init__(self, config: StubConfig, host: str = "127.0.0.1", port: int = 0):
+        self.app = create_app(config)
+        self.server = uvicorn.Server(
+            uvicorn.Config(self.app, host=host, port=port, log_level="warning")
+        )
+        self.task: asyncio.Task | None = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.servers[0].sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def stats(self) -> dict:
+        return self.app.state.stats
+
+    async def __aenter__(self) -> "StubServer":
+        self.task = asyncio.create_task(self.server.serve())
+        while not self.server.started:
+            if self.task.done():
+                self.task.result()
+            await asyncio.sleep(0.01)
+        return self
+
+    async def __aexit__(self, *args):
+        self.server.should_exit = True
+        if self.task:
+            await self.task
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--tps", type=float, default=80)
+    parser.add_argument("--tool-rate", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument(
+        "--replies", help="YAML/JSON 文件，内容为回复字符串列表", default=None
+    )
+    args = parser.parse_args()
+
+    config = StubConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        tps=args.tps,
+        tool_rate=args.tool_rate,
+        error_rate=args.error_rate,
+    )
+    if args.replies:
+        import yaml
+
+        with open(args.replies, encoding="utf-8") as f:
+            config.replies = list(yaml.safe_load(f))
+    uvicorn.run(create_app(config), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+
+from nonebot import logger
+from collections import OrderedDict
+from collections.abc import Iterable
+
+from .chat import chat
+from .config import p_config
+from .metrics import record_usage
+from .image_cache import IMAGE_CACHE, image_key, image_identity, content_identity
+
+CAPTION_PROMPT = "用一句不超过 40 字的中文描述这张图片的内容；如果图片中有文字，简要转述。直接给出描述。"
+
+_CAPTIONS: OrderedDict[str, str] = OrderedDict()
+""" image_key -> 描述，空字符串表示生成失败 """
+_CAPTIONS_SIZE = 4096
+_PENDING: set[str] = set()
+_TASKS: set[asyncio.Task] = set()
+_SEMAPHORE: asyncio.Semaphore | None = None
+
+
+def image_caption(url: str) -> str | None:
+    """已生成的图片描述，没有时返回 None"""
+    return _CAPTIONS.get(image_key(url)) or None
+
+
+def _remember(key: str, caption: str):
+    _CAPTIONS[key] = caption
+    _CAPTIONS.move_to_end(key)
+    if len(_CAPTIONS) > _CAPTIONS_SIZE:
+        _CAPTIONS.popitem(last=False)
+
+
+def request_captions(urls: Iterable[str]):
+    """在后台为被替换为文字的旧图片生成描述，下次渲染时生效"""
+    if not p_config.image_caption_model:
+        return
+    for url in urls:
+        key = image_key(url)
+        if key in _CAPTIONS or key in _PENDING:
+            continue
+        _PENDING.add(key)
+        task = asyncio.create_task(_caption(url, key))
+        _TASKS.add(task)
+        task.add_done_callback(_TASKS.discard)
+
+
+async def _caption(url: str, key: str):
+    global _SEMAPHORE
+    if _SEMAPHORE is None:
+        _SEMAPHORE = asyncio.Semaphore(2)
+    model = p_config.image_caption_model
+    # 描述按图片持久缓存，与链接中的 rkey 无关
+    cache_key = "caption:" + (image_identity(url) or content_identity(url.encode()))
+    try:
+        caption = await IMAGE_CACHE.get(cache_key)
+        if caption is None:
+            async with _SEMAPHORE:
+                rsp = await chat(
+                    message=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": CAPTION_PROMPT},
+                                {
+                                    "type": "image_url",
+                                    "image_url": {"url": url, "detail": "low"},
+                                },
+                            ],
+                        }
+                    ],
+                    model=model,
+                    times=1,
+                    temperature=0.2,
+                )
+            record_usage(rsp.usage, group="caption", model=model)
+            caption = (rsp.choices[0].message.content or "").strip()[:100]
+            if caption:
+                await IMAGE_CACHE.set(cache_key, caption)
+        _remember(key, caption)
+    except Exception as ex:
+        logger.warning(f"生成图片描述失败: {ex}")
+        _remember(key, "")
+    finally:
+        _PENDING.discard(key)
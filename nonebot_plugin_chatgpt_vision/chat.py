@@ -1,20 +1,52 @@
+import re
+import time
 import yaml
-from openai import AsyncOpenAI
+import openai
+import asyncio
+
+from collections import OrderedDict
+
+from nonebot import logger
 from nonebot import get_plugin_config
 from .config import Config
+from .client import get_client
+from .router import (
+    Router,
+    Endpoint,
+    UpstreamError,
+    EmptyResponse,
+    is_transient,
+    retry_after,
+)
 
-OPENAI_CONFIG = {}
+OPENAI_CONFIG: dict[str, list[dict]] = {}
+""" 模型名 -> 端点列表，每个端点包含 api_key、base_url 与可选的限流/连接池参数 """
 try:
     with open("configs/chatgpt-vision/keys.yaml") as f:
         for i in yaml.safe_load(f):
-            OPENAI_CONFIG[i.get("model")] = {
-                "api_key": i.get("key"),
-                "base_url": i.get("url"),
-            }
+            # 同一模型可以重复出现，或在 key 中写列表，以配置多个 key/端点
+            keys = i.get("key")
+            for key in keys if isinstance(keys, list) else [keys]:
+                endpoint = {
+                    "api_key": key,
+                    "base_url": i.get("url"),
+                }
+                for k in (
+                    "max_connections",
+                    "max_keepalive",
+                    "http2",
+                    "fallbacks",
+                    "rpm",
+                    "tpm",
+                ):
+                    if k in i:
+                        endpoint[k] = i[k]
+                OPENAI_CONFIG.setdefault(i.get("model"), []).append(endpoint)
 except Exception:
     pass
 
 p_config: Config = get_plugin_config(Config)
+ROUTER = Router(OPENAI_CONFIG)
 
 
 async def chat(
@@ -22,6 +54,7 @@ async def chat(
     model: str,
     times: int = 3,
     temperature: float = 0.65,
+    hedge: bool = False,
     **kwargs,
 ):
     """
@@ -34,34 +67,258 @@ async def chat(
     model : str
         The model you want to use
     times : int
-        The times you want to try
+        The times you want to try, failing over to the model's fallbacks
+    hedge : bool
+        Fire a second request to another key/endpoint if the first one is
+        slower than the observed latency percentile (needs ``hedge_enabled``)
+    stream : bool
+        Return the ``AsyncStream`` of chunks instead of a completion
     """
-    use_model = model
-    if use_model not in OPENAI_CONFIG:
-        # 回退到配置的 fallback 模型
-        fallback = p_config.fallback_model
-        if fallback in OPENAI_CONFIG:
-            use_model = fallback
-        else:
-            raise ValueError(
-                f"The model {model} is not supported and no fallback configured."
-            )
+    chain = ROUTER.chain(model)
+    if not chain:
+        raise ValueError(
+            f"The model {model} is not supported and no fallback configured."
+        )
+    if kwargs.get("stream") and p_config.openai_stream_usage:
+        kwargs.setdefault("stream_options", {"include_usage": True})
+    tried: set = set()
+    last_error: Exception | None = None
+    for attempt in range(max(1, times)):
+        endpoint = ROUTER.pick(chain, tried)
+        if endpoint is None:
+            break
+        tried.add((endpoint.model, endpoint.key))
+        try:
+            if hedge and attempt == 0 and p_config.hedge_enabled:
+                rsp = await _hedged(
+                    endpoint, chain, tried, message, model, temperature, kwargs
+                )
+            else:
+                rsp = await _attempt(endpoint, message, model, temperature, kwargs)
+        except Exception as ex:
+            if not is_transient(ex):
+                raise
+            last_error = ex
+            logger.warning(f"模型 {model} 请求失败（第 {attempt + 1} 次）：{ex}")
+            if attempt + 1 < times:
+                # 还有未尝试的端点时直接切换，否则退避后重试
+                nxt = ROUTER.pick(chain, tried)
+                if nxt is None or (nxt.model, nxt.key) in tried:
+                    await asyncio.sleep(ROUTER.backoff(attempt, ex))
+            continue
+        return rsp
+    raise UpstreamError(model, last_error)
+
+
+async def _attempt(
+    endpoint: Endpoint,
+    message: list,
+    model: str,
+    temperature: float,
+    kwargs: dict,
+):
+    """向单个端点发起一次请求，并记录健康、限流与延迟"""
+    endpoint.health.begin()
+    endpoint.limiter.acquire()
+    start = time.monotonic()
     try:
-        rsp = await AsyncOpenAI(**OPENAI_CONFIG[use_model]).chat.completions.create(
+        rsp = await get_client(endpoint.config).chat.completions.create(
             messages=message,
-            model=use_model,
+            model=endpoint.model,
             temperature=temperature,
             timeout=60 * 60,
             **kwargs,
         )
-
         if not rsp:
-            raise ValueError("The Response is Null.")
-        if not rsp.choices:
-            raise ValueError("The Choice is Null.")
-        return rsp
-    except Exception:
+            raise EmptyResponse("The Response is Null.")
+        if not kwargs.get("stream") and not rsp.choices:
+            raise EmptyResponse("The Choice is Null.")
+    except BaseException as ex:
+        endpoint.limiter.release()
+        if not is_transient(ex):
+            endpoint.health.probing = False
+        elif isinstance(ex, openai.RateLimitError):
+            # 429 说明该 key 配额用尽，冷却该 key 而不是熔断端点
+            endpoint.health.probing = False
+            endpoint.limiter.throttle(
+                retry_after(ex) or p_config.router_rate_limit_cooldown
+            )
+        else:
+            endpoint.health.record_failure(ex)
         raise
+    latency = time.monotonic() - start
+    endpoint.health.record_success(latency)
+    ROUTER.record_latency(endpoint.model, bool(kwargs.get("stream")), latency)
+    if endpoint.model != model:
+        logger.info(f"模型 {model} 已故障转移到 {endpoint.model}")
+    if kwargs.get("stream"):
+        return ObservedStream(rsp, endpoint)
+    endpoint.limiter.release()
+    if rsp.usage:
+        endpoint.limiter.consume(rsp.usage.total_tokens)
+    return rsp
+
+
+async def _hedged(
+    endpoint: Endpoint,
+    chain: list[Endpoint],
+    tried: set,
+    message: list,
+    model: str,
+    temperature: float,
+    kwargs: dict,
+):
+    """
+    对冲请求：首个请求超过历史延迟分位数仍未返回时，
+    向同一模型的另一个 key/端点再发一个，取先成功者并取消另一个
+    """
+    primary = asyncio.create_task(
+        _attempt(endpoint, message, model, temperature, kwargs)
+    )
+    delay = ROUTER.hedge_delay(endpoint.model, bool(kwargs.get("stream")))
+    if delay is None:
+        return await primary
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done:
+        return primary.result()
+    second = ROUTER.pick([e for e in chain if e.model == endpoint.model], tried)
+    if second is None or (second.model, second.key) in tried:
+        return await primary
+    tried.add((second.model, second.key))
+    stats = ROUTER.hedge_stats(endpoint.model)
+    stats.fired += 1
+    backup = asyncio.create_task(_attempt(second, message, model, temperature, kwargs))
+    pending = {primary, backup}
+    error: BaseException | None = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                if task is backup:
+                    stats.won += 1
+                for other in done - {task}:
+                    if other.exception() is None:
+                        await _discard(other.result())
+                return task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+    assert error is not None
+    raise error
+
+
+async def _discard(rsp):
+    """丢弃对冲中落败但已返回的响应"""
+    if isinstance(rsp, ObservedStream):
+        await rsp.close()
+
+
+class ObservedStream:
+    """透传流式响应，结束时释放并发计数并按 usage 扣除令牌"""
+
+    def __init__(self, stream, endpoint: Endpoint):
+        self.stream = stream
+        self.endpoint = endpoint
+        self.released = False
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self.stream:
+                usage = getattr(chunk, "usage", None)
+                if usage:
+                    self.endpoint.limiter.consume(usage.total_tokens)
+                yield chunk
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.released:
+            return
+        self.released = True
+        self.endpoint.limiter.release()
+        close = getattr(self.stream, "close", None)
+        if close is not None:
+            await close()
+
+
+_ERROR_CACHE: OrderedDict[str, tuple[float, str | None]] = OrderedDict()
+""" 异常指纹 -> (过期时间, 解释)，解释为 None 表示生成失败，直接使用原始报错 """
+
+_ERROR_PATTERNS = [
+    (re.compile(r"https?://\S+"), "<url>"),
+    (re.compile(r"\b[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}\b", re.I), "<id>"),
+    (re.compile(r"\b[A-Za-z]+[-_][A-Za-z0-9_-]*\d[A-Za-z0-9_-]*\b"), "<id>"),
+    (re.compile(r"\b[A-Za-z0-9_-]{24,}\b"), "<id>"),
+    (re.compile(r"\d+(?:\.\d+)?"), "<n>"),
+]
+
+RATE_LIMITED = "请求太频繁，被限流了。"
+
+STATIC_ERRORS: list[tuple[tuple[type, ...], tuple[str, ...], str]] = [
+    (
+        (),
+        (
+            "context_length_exceeded",
+            "maximum context length",
+            "context length",
+            "too many tokens",
+            "prompt is too long",
+        ),
+        "聊天记录太长，超出了模型的上限。",
+    ),
+    (
+        (openai.RateLimitError,),
+        ("rate limit", "quota"),
+        RATE_LIMITED,
+    ),
+    (
+        (openai.APITimeoutError, asyncio.TimeoutError, TimeoutError),
+        ("timed out", "timeout"),
+        "模型服务器响应超时了。",
+    ),
+    (
+        (openai.APIConnectionError,),
+        ("connection error",),
+        "连不上模型服务器。",
+    ),
+    (
+        (openai.InternalServerError,),
+        ("502 bad gateway", "503 service", "internal server error"),
+        "模型服务器出故障了。",
+    ),
+]
+""" (异常类型, 报错关键字, 解释)，按顺序匹配，命中则不再请求模型 """
+
+
+def error_fingerprint(error: str | Exception) -> str:
+    """异常指纹：异常类型 + 去掉 id、URL 与数字后的报错信息"""
+    text = str(error)
+    for pattern, repl in _ERROR_PATTERNS:
+        text = pattern.sub(repl, text)
+    return f"{type(error).__name__}:{text[:500]}"
+
+
+def static_error(error: str | Exception) -> str | None:
+    """从静态表中查找常见报错的解释"""
+    if isinstance(error, UpstreamError):
+        if error.last_error is None:
+            return "模型服务暂时都不可用。"
+        error = error.last_error
+    # 429 按状态码判断，报错文本中的 "429" 可能只是 token 数或 id 的一部分
+    if isinstance(error, openai.APIStatusError) and error.status_code == 429:
+        return RATE_LIMITED
+    text = str(error).lower()
+    for types, keywords, explanation in STATIC_ERRORS:
+        if types and isinstance(error, types):
+            return explanation
+        if any(k in text for k in keywords):
+            return explanation
+    return None
 
 
 async def error_chat(
@@ -70,25 +327,46 @@ async def error_chat(
     temperature: float = 0.2,
     **kwargs,
 ):
+    explanation = static_error(error)
+    if explanation:
+        return explanation
+    fingerprint = error_fingerprint(error)
+    now = time.monotonic()
+    cached = _ERROR_CACHE.get(fingerprint)
+    if cached and cached[0] > now:
+        _ERROR_CACHE.move_to_end(fingerprint)
+        return cached[1] or str(error)
+
+    explanation = await _explain_error(error, model, temperature, **kwargs)
+    _ERROR_CACHE[fingerprint] = (now + p_config.error_cache_ttl, explanation)
+    _ERROR_CACHE.move_to_end(fingerprint)
+    while len(_ERROR_CACHE) > p_config.error_cache_size:
+        _ERROR_CACHE.popitem(last=False)
+    return explanation or str(error)
+
+
+async def _explain_error(
+    error: str | Exception,
+    model: str | None = None,
+    temperature: float = 0.2,
+    **kwargs,
+) -> str | None:
     use_model = model or p_config.fallback_model
     if use_model not in OPENAI_CONFIG:
-        return str(error)
+        return None
     try:
-        rsp = await AsyncOpenAI(**OPENAI_CONFIG[use_model]).chat.completions.create(
-            messages=[
+        rsp = await chat(
+            message=[
                 {
                     "role": "user",
                     "content": f"```\n{error}\n```\n\n请为上面的报错生成一段大约15字的解释，将会直接提交给前台显示给用户，所以你不能包含任何代码，也不能涉及隐私信息。\n不需要在开头回复“好的”之类的，直接给出你生成的结果。",
                 }
             ],
             model=use_model,
+            times=1,
             temperature=temperature,
             **kwargs,
         )
-        if not rsp:
-            raise ValueError("The Response is Null.")
-        if not rsp.choices:
-            raise ValueError("The Choice is Null.")
         return rsp.choices[0].message.content
     except Exception:
-        return str(error)
+        return None
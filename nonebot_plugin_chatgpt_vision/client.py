@@ -0,0 +1,92 @@
+import httpx
+
+from nonebot import logger
+from nonebot import get_driver
+from openai import AsyncOpenAI
+from openai import DefaultAsyncHttpxClient
+
+from .config import p_config
+
+try:
+    import h2  # type: ignore # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+_CLIENTS: dict[tuple[str | None, str | None], AsyncOpenAI] = {}
+""" (base_url, api_key) -> 共享连接池的客户端 """
+_HTTP_CLIENT: httpx.AsyncClient | None = None
+
+
+def get_client(config: dict) -> AsyncOpenAI:
+    """
+    获取端点对应的 AsyncOpenAI 客户端，同一 (base_url, api_key) 复用同一个连接池
+
+    Parameters:
+    -----------
+    config: dict
+        keys.yaml 中的端点配置，包含 api_key、base_url，
+        以及可选的 max_connections、max_keepalive、http2
+
+    Returns:
+    --------
+    AsyncOpenAI
+        共享的客户端
+    """
+    key = (config.get("base_url"), config.get("api_key"))
+    client = _CLIENTS.get(key)
+    if client is not None:
+        return client
+
+    http2 = bool(config.get("http2", p_config.openai_http2))
+    if http2 and not HTTP2_AVAILABLE:
+        logger.warning(
+            "HTTP/2 需要安装 h2（pip install httpx[http2]），已回退到 HTTP/1.1"
+        )
+        http2 = False
+    limits = httpx.Limits(
+        max_connections=config.get("max_connections", p_config.openai_max_connections),
+        max_keepalive_connections=config.get(
+            "max_keepalive", p_config.openai_max_keepalive
+        ),
+        keepalive_expiry=p_config.openai_keepalive_expiry,
+    )
+    client = AsyncOpenAI(
+        api_key=key[1],
+        base_url=key[0],
+        # 重试与故障转移由 router 负责
+        max_retries=0,
+        http_client=DefaultAsyncHttpxClient(limits=limits, http2=http2),
+    )
+    _CLIENTS[key] = client
+    return client
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """获取下载、检查图片等通用请求共享的 httpx 客户端（使用 tool_proxy_url）"""
+    global _HTTP_CLIENT
+    if _HTTP_CLIENT is None or _HTTP_CLIENT.is_closed:
+        _HTTP_CLIENT = httpx.AsyncClient(
+            proxy=p_config.tool_proxy_url,
+            timeout=10,
+        )
+    return _HTTP_CLIENT
+
+
+async def close_clients():
+    """关闭所有共享客户端"""
+    global _HTTP_CLIENT
+    clients = list(_CLIENTS.values())
+    _CLIENTS.clear()
+    for client in clients:
+        try:
+            await client.close()
+        except Exception as ex:
+            logger.warning(f"关闭 OpenAI 客户端失败: {ex}")
+    if _HTTP_CLIENT is not None:
+        await _HTTP_CLIENT.aclose()
+        _HTTP_CLIENT = None
+
+
+get_driver().on_shutdown(close_clients)
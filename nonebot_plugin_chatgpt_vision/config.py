@@ -8,15 +8,107 @@ class Config(BaseModel):
     fallback_model: str = "gemini-2.5-flash"
     """ 回退模型，一个用户达到限额或默认模型不可用时调用 """
 
+    # OpenAI 客户端连接池（可在 keys.yaml 中按端点覆盖）
+    openai_max_connections: int = 100
+    """ 每个端点（base_url + key）的最大连接数 """
+    openai_max_keepalive: int = 20
+    """ 每个端点保持的空闲长连接数 """
+    openai_keepalive_expiry: float = 60
+    """ 空闲长连接的保持时间（秒） """
+    openai_http2: bool = False
+    """ 是否启用 HTTP/2，需要安装 h2 """
+
+    # 端点健康路由与熔断
+    router_failure_threshold: int = 3
+    """ 连续失败多少次后熔断端点 """
+    router_open_seconds: float = 30
+    """ 熔断持续时间（秒），之后放行一个探测请求 """
+    router_backoff_base: float = 0.5
+    """ 重试退避的基数（秒），按指数增长并加入随机抖动 """
+    router_backoff_max: float = 8
+    """ 单次重试退避的上限（秒） """
+    router_ewma_alpha: float = 0.2
+    """ 错误率与延迟滑动平均的平滑系数 """
+    router_rate_limit_cooldown: float = 20
+    """ 收到 429 且没有 Retry-After 时，key 的冷却时间（秒） """
+    openai_stream_usage: bool = True
+    """ 流式请求时是否要求返回 usage（stream_options.include_usage），用于 TPM 统计 """
+
+    # 报错解释缓存
+    error_cache_ttl: float = 3600
+    """ 同一类报错（按指纹）的解释缓存时间（秒） """
+    error_cache_size: int = 256
+    """ 报错解释缓存的最大条目数 """
+
+    # 对冲请求（仅在被 @ 时使用）
+    hedge_enabled: bool = False
+    """ 被 @ 时，首个请求慢于历史延迟分位数则向另一个 key/端点再发一个，取先返回者 """
+    hedge_percentile: float = 0.9
+    """ 触发对冲的延迟分位数 """
+    hedge_min_samples: int = 20
+    """ 延迟样本数少于此值时不对冲 """
+    hedge_window: int = 200
+    """ 每个模型保留的延迟样本数 """
+
     # 拟人聊天
     chat_mode: bool = False
     chat_max_log: int = 60
+    chat_max_tokens: int = 0
+    """ 每个群上下文的 token 预算（含系统提示），0 表示只按 chat_max_log 条数裁剪 """
     chat_group: list[str] = []
     # 是否去除每句话末尾的句号
     chat_remove_period: bool = True
+    chat_stream: bool = False
+    """ 是否默认流式获取回复（可在群配置中用 stream 覆盖） """
+
+    # 聊天记录持久化
+    storage_backend: str = "yaml"
+    """ yaml：每次保存重写整个文件；journal：只追加变更日志，定期压缩为快照；sqlite：保存到 data/human/human.db """
+    storage_save_interval: float = 5.0
+    """ 同一个群两次保存的最小间隔（秒），期间的修改在后台合并为一次写入 """
+    journal_fsync_interval: float = 1.0
+    """ journal 模式下合并 fsync 的间隔（秒），0 表示每次保存都 fsync """
+    journal_compact_ops: int = 500
+    """ journal 模式下日志条数达到此值时写入快照并清空日志 """
 
     # 图片与识别
     image_mode: int = 1
+    image_tokens: int = 765
+    """ 估算 token 预算时每张图片的固定开销 """
+    image_concurrency: int = 8
+    """ 同时下载、转换的图片数上限（全局） """
+    image_check_ttl: float = 300
+    """ 图片链接可访问性检查结果的缓存时间（秒），0 表示不缓存 """
+    rkey_url: str = "https://llob.linyuchen.net/rkey"
+    """ 获取 QQ 图片 rkey 的接口，后台定期刷新，为空则不刷新 """
+    image_cache_dir: str = "data/image_cache"
+    """ 图片转换结果的磁盘缓存目录，为空则只使用内存缓存 """
+    image_cache_size: float = 512
+    """ 磁盘缓存的大小上限（MiB），超出时淘汰最久未使用的 """
+    image_cache_memory: float = 32
+    """ 内存缓存的大小上限（MiB） """
+    image_workers: int = 2
+    """ 图片转换、公式渲染的工作进程数，0 表示使用线程 """
+    image_max_bytes: float = 10
+    """ 下载图片的大小上限（MiB），超出时中止下载 """
+    image_max_pixels: int = 25_000_000
+    """ 处理图片的像素数上限，0 表示不限制 """
+    image_max_edge: int = 1280
+    """ 发给模型前把图片缩放到的最长边（像素），0 表示不预处理 """
+    image_format: str = "jpeg"
+    """ 预处理后的图片格式，jpeg 或 webp """
+    image_quality: int = 85
+    """ 预处理时的编码质量 """
+    image_dedup: bool = True
+    """ 窗口内重复的图片（相同文件或感知哈希相近）只发送一次 """
+    image_full_detail: int = 0
+    """ 最近的多少张图片以原始细节发送，更早的使用 detail: low，0 表示不限制 """
+    image_keep: int = 0
+    """ 只有最近的多少张图片以图片发送，更早的替换为文字描述 """
+    image_keep_records: int = 0
+    """ 最近多少条记录中的图片总是以图片发送；与 image_keep 都为 0 时不替换 """
+    image_caption_model: str = ""
+    """ 为被替换的旧图片生成描述的模型（需支持识图），为空则不生成 """
 
     # MCP（Model Context Protocol）
     mcp_enabled: bool = False
@@ -27,6 +119,12 @@ class Config(BaseModel):
     tool_proxy_url: Optional[str] = None
     """ 工具代理服务器地址，若为空则不使用代理 """
 
+    # 指标
+    metrics_path: str = ""
+    """ Prometheus 文本格式指标的 HTTP 路由（需要支持 HTTP 服务的驱动器），如 /chatgpt_vision/metrics，为空则不启用 """
+    metrics_token: str = ""
+    """ 访问指标路由需要的 token（?token= 或 Authorization: Bearer），未设置时不启用路由 """
+
     # Markdown 渲染
     markdown_server: str = ""
     """ Markdown 渲染服务器，若为空则不渲染 """
@@ -1,4 +1,5 @@
 import json
+import time
 import yaml
 import httpx
 import random
@@ -12,15 +13,26 @@ from datetime import timedelta
 
 from .chat import chat
 from .chat import error_chat
+from .router import is_transient
+from .caption import request_captions
+from .client import get_http_client
+from .metrics import METRICS, record_usage
 from .tools import (
     Tool,
     MCPTool,
     ToolManager,
     load_mcp_clients_from_yaml,
 )
-from .utils import fix_xml, GLOBAL_PROMPT, download_image_to_base64, FORBIDDEN_TOOLS
+from .utils import (
+    fix_xml,
+    GLOBAL_PROMPT,
+    FORBIDDEN_TOOLS,
+    ParagraphStream,
+    prepare_image,
+    estimate_tokens,
+)
 from .config import p_config
-from .record import RecordSeg, RecordList, XML_PROMPT
+from .record import RecordSeg, RecordKind, RecordList, XML_PROMPT
 from .tools.code import MmaTool, PyTool
 from .tools.block import BlockTool, ListBlockedTool, BanUser
 from .tools.internet import FetchUrlTool, SearchTool
@@ -32,6 +44,7 @@ class SpecialOperation(Enum):
 
 
 class GroupRecord:
+    group_id: str = ""
     msgs: RecordList
     system_prompt: str
     model: str = p_config.fallback_model
@@ -44,6 +57,10 @@ class GroupRecord:
     min_rest: int = 40
     cd: timedelta = timedelta(seconds=5)
     max_logs: int = p_config.chat_max_log
+    max_tokens: int = p_config.chat_max_tokens
+    """上下文的 token 预算（含系统提示），0 表示只按条数裁剪"""
+    token_scale: float = 1.0
+    """按上游返回的 prompt_tokens 校准 token 估算的系数"""
 
     image_mode: int = 0
     todo_ops: list[tuple[SpecialOperation, Any]]
@@ -54,6 +71,8 @@ class GroupRecord:
 
     show_tool_result: bool = True
     """显示工具调用的结果"""
+    stream: bool = p_config.chat_stream
+    """是否流式获取回复，每闭合一个段落就立即发送"""
 
     lock: asyncio.Lock
     include_tool_id: bool = True
@@ -76,9 +95,11 @@ class GroupRecord:
         default_tools: list[str] | None = None,
         mcp_config: str | dict | None = None,
         include_tool_id: bool = True,
+        group_id: str = "",
         **kwargs,
     ):
         self.todo_ops = []
+        self.group_id = group_id
         if model:
             self.model = model
         self.bot_name = bot_name
@@ -208,11 +229,13 @@ class GroupRecord:
         max_rest: Optional[int] = None,
         cd: Optional[float] = None,
         max_logs: Optional[int] = None,
+        max_tokens: Optional[int] = None,
         image_mode: Optional[int] = None,
         base64: Optional[bool] = None,
         first_msg: Optional[dict] = None,
         show_tool_result: Optional[bool] = None,
         model_weights: Optional[dict[str, float]] = None,
+        stream: Optional[bool] = None,
         **kwargs,
     ):
         if bot_name is not None:
@@ -231,6 +254,8 @@ class GroupRecord:
             self.cd = timedelta(seconds=cd)
         if max_logs is not None:
             self.max_logs = max_logs
+        if max_tokens is not None:
+            self.max_tokens = max_tokens
         if image_mode is not None:
             self.image_mode = image_mode
         if base64 is not None:
@@ -248,32 +273,60 @@ class GroupRecord:
             self.show_tool_result = show_tool_result
         if model_weights is not None:
             self.model_weights = model_weights
+        if stream is not None:
+            self.stream = stream
 
     async def append(
         self,
         record: RecordSeg,
     ):
         async def _(url: str, client: httpx.AsyncClient) -> str | None:
-            if url.startswith("data:"):
+            # 链接形式的图片由服务商下载，只有 base64 模式才需要自行处理
+            if not self.base64 and not url.startswith("data:"):
                 return url
-            r = await download_image_to_base64(url, client)
+            r = await prepare_image(url, client)
             if not r.startswith("data:"):
                 return None
             return r
 
-        if self.base64:
-            async with httpx.AsyncClient(proxy=p_config.tool_proxy_url) as client:
-                record.images = list(
-                    filter(
-                        None,
-                        await asyncio.gather(
-                            *[_(url, client) for url in record.images]
-                        ),
-                    )
+        client = get_http_client()
+        for owner in (record, record.reply):
+            if not owner or not owner.images:
+                continue
+            owner.images = list(
+                filter(
+                    None,
+                    await asyncio.gather(*[_(url, client) for url in owner.images]),
                 )
+            )
         self.msgs.add(record)
         while len(self.msgs) > self.max_logs:
             self.msgs.remove(0)
+        if self.max_tokens > 0:
+            image_mode = self.image_mode == 1
+            budget = self.max_tokens / self.token_scale - self.prefix_tokens()
+            total = self.msgs.tokens(image_mode)
+            while len(self.msgs) > 1 and total > budget:
+                total -= sum(r.tokens(image_mode) for r in self.msgs.remove(0))
+
+    def prefix_tokens(self) -> int:
+        """估算系统提示与首条消息占用的 token 数"""
+        system = self.system()
+        cached = getattr(self, "_prefix_tokens", None)
+        if cached and cached[0] == system and cached[1] is self.first_msg:
+            return cached[2]
+        n = estimate_tokens(system)
+        if self.first_msg:
+            n += self.first_msg.tokens(self.image_mode == 1)
+        self._prefix_tokens = (system, self.first_msg, n)
+        return n
+
+    def calibrate(self, estimated: int, prompt_tokens: int | None):
+        """用上游实际的 prompt_tokens 校准估算系数"""
+        if not estimated or not prompt_tokens:
+            return
+        ratio = min(4.0, max(0.25, prompt_tokens / estimated))
+        self.token_scale = self.token_scale * 0.8 + ratio * 0.2
 
     def block(self, id: str, delta: float = 150) -> float:
         try:
@@ -332,13 +385,29 @@ class GroupRecord:
                 }
             )
 
-        return prefix + self.msgs.message(self.bot_id, self.image_mode == 1)
+        return prefix + self.msgs.message(
+            self.bot_id,
+            self.image_mode == 1,
+            p_config.image_full_detail,
+            p_config.image_dedup,
+            p_config.image_keep,
+            p_config.image_keep_records,
+        )
 
     def remake(self):
         self.msgs = RecordList()
         self.block_list = {}
 
-    async def say(self) -> AsyncIterator[str]:
+    async def say(self, hedge: bool = False) -> AsyncIterator[str]:
+        """
+        生成回复
+
+        Parameters:
+        -----------
+        hedge: bool
+            是否允许对冲请求，仅在被 @ 等对延迟敏感的场景开启
+        """
+
         async def recursive(
             self: "GroupRecord", recursion_depth: int = 5
         ) -> AsyncIterator[str]:
@@ -361,8 +430,30 @@ class GroupRecord:
                     )
                     tools = None
 
-                await self.msgs.remove_bad_images()
+                bad_images = await self.msgs.remove_bad_images()
+                if bad_images:
+                    METRICS.inc(
+                        "chatgpt_vision_bad_images_total",
+                        bad_images,
+                        group=self.group_id,
+                    )
                 messages = self.merge()
+                if self.msgs.saved_images:
+                    METRICS.inc(
+                        "chatgpt_vision_image_dedup_total",
+                        self.msgs.saved_images,
+                        group=self.group_id,
+                    )
+                if self.msgs.aged_images:
+                    METRICS.inc(
+                        "chatgpt_vision_image_aged_total",
+                        len(self.msgs.aged_images),
+                        group=self.group_id,
+                    )
+                    request_captions(self.msgs.aged_images)
+                estimated = self.prefix_tokens() + self.msgs.tokens(
+                    self.image_mode == 1
+                )
 
                 if self.next_model:
                     model, self.next_model = self.next_model, None
@@ -373,39 +464,150 @@ class GroupRecord:
                 logger.info(f"Using model: {model}")
 
                 # 调用带工具的聊天API
-                msg = await chat(
-                    message=messages,
-                    model=model,
-                    temperature=0.8,
-                    max_tokens=4096 * 16,
-                    tools=tools if tools else None,
-                    tool_choice="auto" if tools else None,
-                )
+                labels = {"group": self.group_id, "model": model}
+                METRICS.inc("chatgpt_vision_requests_total", **labels)
+                started = time.monotonic()
+                try:
+                    msg = await chat(
+                        message=messages,
+                        model=model,
+                        temperature=0.8,
+                        max_tokens=4096 * 16,
+                        tools=tools if tools else None,
+                        tool_choice="auto" if tools else None,
+                        stream=self.stream,
+                        hedge=hedge,
+                    )
+                except Exception:
+                    METRICS.inc("chatgpt_vision_request_errors_total", **labels)
+                    raise
+                # 只统计等待上游的时间，不含 yield 后被挂起（发送消息）的时间
+                elapsed = time.monotonic() - started
 
-                choice = msg.choices[0]
                 content = ""
-                record_msg: list[tuple[str, str]] = []
+                raw_content = ""
+                thinking = ""
+                tool_calls: list[dict[str, Any]] = []
                 should_record = False
                 now = datetime.now()
-                if getattr(choice.message, "content", None):
-                    content = await asyncio.to_thread(
-                        fix_xml,
-                        choice.message.content.replace("[NULL]", ""),
-                        convert_face_to_image=True,
+                if self.stream:
+                    # 流式：每闭合一个 <p> 就立即规约并发送
+                    paragraphs: list[str] = []
+                    splitter = ParagraphStream()
+                    calls: dict[int, dict[str, Any]] = {}
+                    reasoning: list[str] = []
+
+                    async def _fix(raw: str) -> str:
+                        return await asyncio.to_thread(
+                            fix_xml,
+                            raw.replace("[NULL]", ""),
+                            convert_face_to_image=True,
+                        )
+
+                    async def _upstream(stream):
+                        nonlocal elapsed
+                        iterator = stream.__aiter__()
+                        while True:
+                            waiting = time.monotonic()
+                            try:
+                                chunk = await iterator.__anext__()
+                            except StopAsyncIteration:
+                                return
+                            finally:
+                                elapsed += time.monotonic() - waiting
+                            yield chunk
+
+                    async for chunk in _upstream(msg):
+                        if getattr(chunk, "usage", None):
+                            self.calibrate(estimated, chunk.usage.prompt_tokens)
+                            record_usage(chunk.usage, **labels)
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta
+                        if getattr(delta, "reasoning_content", None):
+                            reasoning.append(delta.reasoning_content)
+                        if delta.content:
+                            raw_content += delta.content
+                            for raw in splitter.feed(delta.content):
+                                p = await _fix(raw)
+                                if p and p != "<p></p>":
+                                    paragraphs.append(p)
+                                    yield p
+                        for tc in delta.tool_calls or []:
+                            slot = calls.setdefault(
+                                tc.index,
+                                {
+                                    "id": None,
+                                    "type": "function",
+                                    "function": {"name": "", "arguments": ""},
+                                },
+                            )
+                            if tc.id:
+                                slot["id"] = tc.id
+                            if tc.type:
+                                slot["type"] = tc.type
+                            if tc.function:
+                                if tc.function.name:
+                                    slot["function"]["name"] += tc.function.name
+                                if tc.function.arguments:
+                                    slot["function"][
+                                        "arguments"
+                                    ] += tc.function.arguments
+                    rest = splitter.close()
+                    if rest:
+                        p = await _fix(rest)
+                        if p and p != "<p></p>":
+                            paragraphs.append(p)
+                            yield p
+                    content = "".join(paragraphs)
+                    thinking = "".join(reasoning)
+                    tool_calls = [calls[i] for i in sorted(calls)]
+                else:
+                    if msg.usage:
+                        self.calibrate(estimated, msg.usage.prompt_tokens)
+                        record_usage(msg.usage, **labels)
+                    choice = msg.choices[0]
+                    raw_content = getattr(choice.message, "content", None) or ""
+                    if raw_content:
+                        content = await asyncio.to_thread(
+                            fix_xml,
+                            raw_content.replace("[NULL]", ""),
+                            convert_face_to_image=True,
+                        )
+                        yield content
+                    thinking = getattr(choice.message, "reasoning_content", "") or ""
+                    if getattr(choice.message, "tool_calls", None):
+                        tool_calls = choice.message.model_dump()["tool_calls"]
+
+                METRICS.observe(
+                    "chatgpt_vision_request_seconds",
+                    elapsed,
+                    **labels,
+                )
+                if not tool_calls:
+                    METRICS.inc(
+                        "chatgpt_vision_replies_total",
+                        group=self.group_id,
+                        null=str(
+                            "[NULL]" in raw_content
+                            or not content
+                            or content == "<p></p>"
+                        ).lower(),
                     )
+
+                text = ""
+                if raw_content:
                     if content and content != "<p></p>":
                         should_record = True
-                    yield content
-                    thinking = getattr(choice.message, "reasoning_content", "")
                     if thinking:
                         thinking = "<think>" + thinking + "</think>"
-                    record_msg.append(("content", thinking + content))
+                    text = thinking + content
 
                 # 检查是否有工具调用
-                if getattr(choice.message, "tool_calls", None):
+                recorded_calls: list[dict[str, Any]] = []
+                if tool_calls:
                     should_record = True
-                    tool_calls = choice.message.model_dump()["tool_calls"]
-                    tool_calls = [
+                    recorded_calls = [
                         {
                             "function": {
                                 "name": tc["function"]["name"],
@@ -417,34 +619,37 @@ class GroupRecord:
                         for tc in tool_calls
                     ]
                     if not self.include_tool_id:
-                        for tc in tool_calls:
+                        for tc in recorded_calls:
                             if "id" in tc:
                                 del tc["id"]
-                    record_msg.append(
-                        (
-                            "tool_calls",
-                            str(
-                                yaml.safe_dump(
-                                    tool_calls,
-                                    allow_unicode=True,
-                                )
+                if should_record:
+                    await self.append(
+                        RecordSeg(
+                            self.bot_name,
+                            self.bot_id,
+                            text,
+                            "content",
+                            now,
+                            kind=(
+                                RecordKind.TOOL_CALLS
+                                if recorded_calls
+                                else RecordKind.ASSISTANT
                             ),
+                            tool_calls=recorded_calls,
                         )
                     )
-                if should_record:
-                    record = RecordSeg(self.bot_name, self.bot_id, "", 0, now)
-                    record.msg = record_msg
-                    await self.append(record)
 
-                if getattr(choice.message, "tool_calls", None):
+                if tool_calls:
                     # 携带工具结果继续获取最终回复
                     if not content:
                         yield "<p>[使用工具中...]</p>"
 
-                    async def _(tool_call) -> str:
+                    async def _(tool_call: dict[str, Any]) -> str:
                         nonlocal self
-                        function_name = tool_call.function.name
-                        function_args = json.loads(tool_call.function.arguments)
+                        function_name = tool_call["function"]["name"]
+                        function_args = json.loads(
+                            tool_call["function"]["arguments"] or "{}"
+                        )
                         try:
                             result = await self.tool_manager.execute_tool(
                                 function_name, **function_args
@@ -452,7 +657,14 @@ class GroupRecord:
                         except Exception as ex:
                             result = f"工具调用失败：{ex}"
                         await self.append(
-                            RecordSeg(function_name, "tool", result, tool_call.id, now)
+                            RecordSeg(
+                                function_name,
+                                "tool",
+                                result,
+                                tool_call["id"],
+                                now,
+                                kind=RecordKind.TOOL,
+                            )
                         )
                         return (
                             f"<p><code lang=\"markdown\"><![CDATA[# {function_name.replace(']]>', ']]]]><![CDATA[>')}\n"
@@ -466,9 +678,7 @@ class GroupRecord:
                             "```]]></code></p>"
                         )
 
-                    for tr in asyncio.as_completed(
-                        [_(tc) for tc in choice.message.tool_calls]
-                    ):
+                    for tr in asyncio.as_completed([_(tc) for tc in tool_calls]):
                         r = await tr
                         if self.show_tool_result:
                             yield r
@@ -476,6 +686,10 @@ class GroupRecord:
                         yield i
             except Exception as ex:
                 logger.error(ex)
+                if is_transient(ex):
+                    # 上游暂时不可用，保留上下文
+                    yield fix_xml(f"发生错误：{await error_chat(ex)}稍后再试试吧。")
+                    return
                 with open(
                     f"./bug-{datetime.now().timestamp()}.yaml", "w", encoding="utf-8"
                 ) as f:
@@ -494,7 +708,16 @@ class GroupRecord:
                 return
 
         async with self.lock:
+            started = time.monotonic()
+            first = True
             async for x in recursive(self):
+                if first and x.strip():
+                    first = False
+                    METRICS.observe(
+                        "chatgpt_vision_first_paragraph_seconds",
+                        time.monotonic() - started,
+                        group=self.group_id,
+                    )
                 yield x
 
     def ban(self, user_id: str, duration: float):
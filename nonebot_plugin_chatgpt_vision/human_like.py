@@ -3,10 +3,12 @@ import re
 import yaml
 import httpx
 import random
+import asyncio
 import pathlib
 
-from nonebot import on_command, on_notice, on_message, logger
+from nonebot import on_command, on_notice, on_message, logger, get_driver
 from datetime import datetime
+from collections.abc import Iterable, Iterator
 from nonebot.rule import Rule
 from nonebot.rule import to_me
 from nonebot.params import CommandArg
@@ -30,9 +32,12 @@ from .utils import (
     correct_tencent_image_url,
 )
 from .config import p_config
+from .chat import ROUTER
+from .metrics import METRICS
 from .picsql import randpic
 from .record import RecordSeg, RecordList, xml_to_v11msg, v11msg_to_xml_async
-
+from .storage import create_storage
+from .storage.writer import CoalescingWriter
 
 _CONFIG: dict = {}
 try:
@@ -66,23 +71,72 @@ for files in pathlib.Path("./configs/chatgpt-vision/configs").glob("*.yaml"):
         logger.error(ex)
 
 
-GROUP_RECORD: dict = {}
-for v in p_config.chat_group:
-    if str(v) not in GROUP_RECORD:
-        GROUP_RECORD[str(v)] = GroupRecord(**_CONFIG.get(str(v), {}))
+STORAGE = create_storage(p_config.storage_backend, "./data/human")
+
+
+def restore_group_record(group: GroupRecord, state: dict):
+    group.msgs = state.get("msgs", RecordList())
+    group.rest = state.get("rest", 100)
+    group.block_list = state.get("block_list", {})
+    group.credit = state.get("credit", 1)
+
+
+class GroupRecords:
+    """
+    群号 -> GroupRecord
+
+    启动时只记录群号（chat_group 与已保存的群），
+    首次 await get() 某个群时才创建 GroupRecord，并在线程中读取它的聊天记录
+    """
+
+    def __init__(self, group_ids: Iterable[str]):
+        self.group_ids = set(group_ids)
+        self.loaded: dict[str, GroupRecord] = {}
+        self.loading: dict[str, asyncio.Task[GroupRecord]] = {}
+
+    def __contains__(self, group_id: object) -> bool:
+        return group_id in self.group_ids
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.group_ids)
+
+    def __len__(self) -> int:
+        return len(self.group_ids)
+
+    async def get(self, group_id: str) -> GroupRecord:
+        group = self.loaded.get(group_id)
+        if group is not None:
+            return group
+        if group_id not in self.group_ids:
+            raise KeyError(group_id)
+        # 同一个群的多个事件同时到达时只读取一次
+        task = self.loading.get(group_id)
+        if task is None:
+            task = asyncio.create_task(self._load(group_id))
+            self.loading[group_id] = task
+            task.add_done_callback(lambda _: self.loading.pop(group_id, None))
+        return await asyncio.shield(task)
+
+    async def _load(self, group_id: str) -> GroupRecord:
+        group = GroupRecord(group_id=group_id, **_CONFIG.get(group_id, {}))
+        try:
+            state = await asyncio.to_thread(STORAGE.load, group_id)
+            if state is not None:
+                restore_group_record(group, state)
+        except Exception as ex:
+            logger.error(f"读取群 {group_id} 的聊天记录失败: {ex}")
+        self.loaded[group_id] = group
+        return group
+
+
 try:
-    for files in pathlib.Path("./data/human").glob("*.yaml"):
-        with open(files, "r", encoding="utf-8") as f:
-            data: dict = yaml.load(f, yaml.UnsafeLoader)  # type: ignore
-            for k in data:
-                if k not in GROUP_RECORD:
-                    GROUP_RECORD[k] = GroupRecord(**_CONFIG.get(k, {}))
-                GROUP_RECORD[k].msgs = data[k].get("msgs", RecordList())
-                GROUP_RECORD[k].rest = data[k].get("rest", 100)
-                GROUP_RECORD[k].block_list = data[k].get("block_list", {})
-                GROUP_RECORD[k].credit = data[k].get("credit", 1)
+    _SAVED_GROUPS = STORAGE.groups()
 except Exception as ex:
     print(ex)
+    _SAVED_GROUPS = []
+GROUP_RECORD = GroupRecords([str(v) for v in p_config.chat_group] + _SAVED_GROUPS)
+WRITER = CoalescingWriter(STORAGE, GROUP_RECORD.loaded, p_config.storage_save_interval)
+get_driver().on_shutdown(WRITER.close)
 
 remake = on_command(
     "remake",
@@ -107,6 +161,20 @@ reload_config = on_command(
     priority=5,
     block=True,
 )
+llm_metrics = on_command(
+    "llm_metrics",
+    rule=to_me(),
+    permission=SUPERUSER,
+    priority=5,
+    block=True,
+)
+llm_status = on_command(
+    "llm_status",
+    rule=to_me(),
+    permission=SUPERUSER,
+    priority=5,
+    block=True,
+)
 
 
 async def human_like_group(bot: Bot, event: Event) -> bool:
@@ -135,7 +203,13 @@ humanlike = on_message(rule=Rule(human_like_group), priority=1, block=False)
 human_notion = on_notice(rule=Rule(human_like_on_notice))
 
 
-async def say(group: GroupRecord, event, bot: Bot, matcher: type[Matcher]):
+async def say(
+    group: GroupRecord,
+    event,
+    bot: Bot,
+    matcher: type[Matcher],
+    hedge: bool = False,
+):
     async def convert_image(msg: V11Msg) -> V11Msg:
         async with httpx.AsyncClient(proxy=p_config.tool_proxy_url) as client:
             for seg in msg:
@@ -192,7 +266,7 @@ async def say(group: GroupRecord, event, bot: Bot, matcher: type[Matcher]):
                     seg.data["file"] = "https://demofree.sirv.com/nope-not-here.jpg"
         return msg
 
-    async for s in group.say():
+    async for s in group.say(hedge=hedge):
         if not s.strip():
             continue
         for p in xml_to_v11msg(s):
@@ -237,22 +311,9 @@ async def say(group: GroupRecord, event, bot: Bot, matcher: type[Matcher]):
         group.todo_ops = []
 
 
-async def save_group_record(group_id: str):
-    group: GroupRecord = GROUP_RECORD[group_id]
-    async with group.lock:
-        with open(f"./data/human/{group_id}.yaml", "w+", encoding="utf-8") as f:
-            yaml.dump(
-                {
-                    group_id: {
-                        "msgs": group.msgs,
-                        "rest": group.rest,
-                        "block_list": group.block_list,
-                        # "credit": group.credit,
-                    }
-                },
-                f,
-                allow_unicode=True,
-            )
+def save_group_record(group_id: str):
+    """标记群需要保存，由后台合并写入"""
+    WRITER.mark_dirty(group_id)
 
 
 @humanlike.handle()
@@ -263,21 +324,8 @@ async def _(bot: V11Bot, event: V11G, state):
     ).get("nickname", "")
     if not user_name or not user_name.strip():
         user_name = str(event.sender.user_id)[:5]
-    group: GroupRecord = GROUP_RECORD[str(event.group_id)]
+    group = await GROUP_RECORD.get(str(event.group_id))
 
-    reply = None
-    if event.reply:
-        msg, imgs = await v11msg_to_xml_async(
-            event.reply.message, str(event.reply.message_id)
-        )
-        reply = RecordSeg(
-            name=event.reply.sender.nickname or "",
-            uid=str(event.reply.sender.user_id),
-            msg=msg,
-            msg_id=event.reply.message_id,
-            time=datetime.fromtimestamp(event.reply.time),
-            images=imgs,
-        )
     msg = event.message
     is_command = msg.extract_plain_text().startswith("/")
     is_to_me = await to_me()(bot=bot, event=event, state=state)
@@ -303,7 +351,23 @@ async def _(bot: V11Bot, event: V11G, state):
     if is_command:
         return
 
-    _msg, imgs = await v11msg_to_xml_async(msg, str(event.message_id))
+    # 引用消息与本条消息的图片并行转换
+    if event.reply:
+        (_msg, imgs), (reply_msg, reply_imgs) = await asyncio.gather(
+            v11msg_to_xml_async(msg, str(event.message_id)),
+            v11msg_to_xml_async(event.reply.message, str(event.reply.message_id)),
+        )
+        reply = RecordSeg(
+            name=event.reply.sender.nickname or "",
+            uid=str(event.reply.sender.user_id),
+            msg=reply_msg,
+            msg_id=event.reply.message_id,
+            time=datetime.fromtimestamp(event.reply.time),
+            images=reply_imgs,
+        )
+    else:
+        _msg, imgs = await v11msg_to_xml_async(msg, str(event.message_id))
+        reply = None
     await group.append(
         RecordSeg(
             name=user_name,
@@ -336,10 +400,10 @@ async def _(bot: V11Bot, event: V11G, state):
         group.next_model = group.model
 
     try:
-        await say(group, event, bot, humanlike)
+        await say(group, event, bot, humanlike, hedge=is_to_me)
     except Exception as ex:
         logger.error(ex)
-    await save_group_record(str(event.group_id))
+    save_group_record(str(event.group_id))
 
 
 @human_notion.handle()
@@ -352,7 +416,7 @@ async def _(bot: V11Bot, event: NoticeEvent):
     if not name:
         name = uid[:5]
 
-    group: GroupRecord = GROUP_RECORD[group_id]
+    group = await GROUP_RECORD.get(group_id)
     if event.notice_type == "group_increase":
         msg = V11Msg([V11Seg.at(uid), V11Seg.text(" 欢迎加入群聊！")])
     elif event.notice_type == "group_decrease":
@@ -372,6 +436,7 @@ async def _(bot: V11Bot, event: NoticeEvent):
         )
     elif event.notice_type == "group_recall":
         group.recall(event.message_id)  # type: ignore
+        save_group_record(group_id)
         return
     else:
         msg = V11Msg([V11Seg.text(f"{name}({uid}) 发生了{event.notice_type}")])
@@ -396,12 +461,12 @@ async def _(bot: V11Bot, event: NoticeEvent):
         await say(group, event, bot, human_notion)
     except Exception as ex:
         print(ex)
-    await save_group_record(group_id)
+    save_group_record(group_id)
 
 
 @remake.handle()
 async def _(bot: Bot, event: V11G, state):
-    group: GroupRecord = GROUP_RECORD[str(event.group_id)]
+    group = await GROUP_RECORD.get(str(event.group_id))
     async with group.lock:
         group.rest = random.randint(group.min_rest, group.max_rest)
         group.remake()
@@ -410,7 +475,7 @@ async def _(bot: Bot, event: V11G, state):
 
 @tool_manager.handle()
 async def _(bot: Bot, event: V11G, p=CommandArg()):
-    group: GroupRecord = GROUP_RECORD[str(event.group_id)]
+    group = await GROUP_RECORD.get(str(event.group_id))
     args: list[str] = p.extract_plain_text().strip().split()
     if args[0] not in ["enable", "disable", "list", "display"]:
         await tool_manager.finish("用法：tool <enable|disable|list|display> [工具名]")
@@ -463,16 +528,66 @@ async def _(bot: Bot, event: Event):
         await reload_config.finish("加载主配置文件失败")
         return
     try:
-        with open(f"./data/human/{group_id}.yaml", "r", encoding="utf-8") as f:
-            data: dict = yaml.load(f, yaml.UnsafeLoader)  # type: ignore
-            for k in data:
-                if k == group_id:
-                    GROUP_RECORD[k].msgs = data[k].get("msgs", RecordList())
-                    GROUP_RECORD[k].rest = data[k].get("rest", 100)
-                    GROUP_RECORD[k].block_list = data[k].get("block_list", {})
-                    GROUP_RECORD[k].credit = data[k].get("credit", 1)
+        # 尚未读取的群在 get 中刚从存储读取过，不必再读一次
+        cold = group_id not in GROUP_RECORD.loaded
+        group = await GROUP_RECORD.get(group_id)
+        if not cold:
+            state = await asyncio.to_thread(STORAGE.load, group_id)
+            if state is not None:
+                restore_group_record(group, state)
     except Exception as ex:
-        print(ex)
+        logger.error(ex)
         await reload_config.finish("加载群配置文件失败")
         return
     await reload_config.finish("配置已重新加载")
+
+
+@llm_status.handle()
+async def _(bot: Bot, event: Event):
+    states = ROUTER.snapshot()
+    if not states:
+        await llm_status.finish("尚无端点请求记录")
+    lines = []
+    for st in states:
+        latency = "-" if st["latency"] is None else f"{st['latency']:.2f}s"
+        lines.append(
+            f"[{st['state']}] {st['endpoint']}\n"
+            f"  模型：{', '.join(st['models']) or '-'}\n"
+            f"  成功 {st['successes']} / 失败 {st['failures']}，"
+            f"错误率 {st['error_rate']:.1%}，延迟 {latency}\n"
+            f"  并发 {st['in_flight']}，RPM 余量 {st['rpm_left'] if st['rpm_left'] is not None else '-'}，"
+            f"TPM 余量 {st['tpm_left'] if st['tpm_left'] is not None else '-'}，"
+            f"已用 {st['used_tokens']} tokens"
+            + (f"，冷却 {st['cooldown']}s" if st["cooldown"] else "")
+            + (f"\n  最近错误：{st['last_error']}" if st["last_error"] else "")
+        )
+    for model, st in ROUTER.hedge_snapshot().items():
+        delay = "-" if st["delay"] is None else f"{st['delay']:.2f}s"
+        win_rate = "-" if st["win_rate"] is None else f"{st['win_rate']:.1%}"
+        lines.append(
+            f"[hedge] {model}：发出 {st['fired']}，对冲胜出 {st['won']}（{win_rate}），阈值 {delay}"
+        )
+    await llm_status.finish("\n".join(lines))
+
+
+@llm_metrics.handle()
+async def _(bot: Bot, event: Event):
+    rows = METRICS.summary()
+    if not rows:
+        await llm_metrics.finish("尚无请求记录")
+    lines = []
+    for r in rows[:20]:
+        group = r["group"] or "-"
+        lines.append(
+            f"{group} / {r['model']}：请求 {r['requests']}（失败 {r['errors']:g}），"
+            f"平均 {r['latency']:.2f}s，"
+            f"tokens 输入 {r['prompt']:g}（缓存 {r['cached']:g}）/ 输出 {r['completion']:g}"
+        )
+    replies = METRICS.get("chatgpt_vision_replies_total")
+    if replies:
+        null = METRICS.get("chatgpt_vision_replies_total", null="true")
+        lines.append(f"[NULL] 回复占比：{null / replies:.1%}")
+    bad = METRICS.get("chatgpt_vision_bad_images_total")
+    if bad:
+        lines.append(f"移除的失效图片：{bad:g}")
+    await llm_metrics.finish("\n".join(lines))
@@ -0,0 +1,213 @@
+import os
+import re
+import asyncio
+import hashlib
+import pathlib
+import threading
+
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from nonebot import logger
+
+from .config import p_config
+from .metrics import METRICS
+
+_MD5_RE = re.compile(r"(?<![0-9A-Fa-f])([0-9A-Fa-f]{32})(?![0-9A-Fa-f])")
+_QQ_HOSTS = ("qq.com.cn", "qq.com", "qpic.cn")
+
+
+def image_identity(url: str) -> str | None:
+    """
+    从 QQ 图片链接中提取稳定的图片标识（fileid 或 md5），与 rkey 等时效参数无关
+
+    Returns:
+    --------
+    str | None
+        无法识别时返回 None
+    """
+    if url.startswith("data:"):
+        return None
+    parsed = urlparse(url)
+    host = parsed.hostname or ""
+    if not host.endswith(_QQ_HOSTS):
+        return None
+    fileid = parse_qs(parsed.query).get("fileid")
+    if fileid and fileid[0]:
+        return "fileid:" + fileid[0]
+    m = _MD5_RE.search(parsed.path)
+    if m:
+        return "md5:" + m.group(1).upper()
+    return None
+
+
+def content_identity(content: bytes) -> str:
+    return "sha256:" + hashlib.sha256(content).hexdigest()
+
+
+_KEYS: OrderedDict[str, str] = OrderedDict()
+_PHASH: OrderedDict[int, int] = OrderedDict()
+_MEMO_SIZE = 4096
+PHASH_DISTANCE = 4
+""" 感知哈希的汉明距离不超过此值时视为同一张图片 """
+
+
+def image_key(url: str) -> str:
+    """
+    用于判断窗口内图片是否重复的键：QQ 图片为其标识，其余为链接本身的哈希
+    """
+    if url.startswith("data:"):
+        # data URL 很长，只用（已缓存在字符串对象上的）哈希值
+        return f"hash:{hash(url):x}:{len(url)}"
+    key = _KEYS.get(url)
+    if key is None:
+        key = image_identity(url) or url
+        _KEYS[url] = key
+        if len(_KEYS) > _MEMO_SIZE:
+            _KEYS.popitem(last=False)
+    return key
+
+
+def remember_phash(url: str, value: int):
+    """记录图片的感知哈希，url 为发给模型的链接或 data URL"""
+    _PHASH[hash(url)] = value
+    _PHASH.move_to_end(hash(url))
+    if len(_PHASH) > _MEMO_SIZE:
+        _PHASH.popitem(last=False)
+
+
+def image_phash(url: str) -> int | None:
+    return _PHASH.get(hash(url))
+
+
+class ImageCache:
+    """
+    图片处理结果的缓存：内存中的热点层 + 磁盘上按总大小 LRU 淘汰的持久层
+
+    值为字符串（通常是 data URL），键由调用方加上用途前缀，例如 png:fileid:xxx。
+    以 @ 开头的值是指向另一个键的别名，用于让多个链接共享同一份内容
+    """
+
+    def __init__(self, root: str, max_bytes: int, memory_bytes: int):
+        self.root = pathlib.Path(root) if root else None
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.memory: OrderedDict[str, str] = OrderedDict()
+        self.memory_size = 0
+        self.index: OrderedDict[str, int] | None = None
+        """磁盘文件名 -> 大小，按最近使用排序，首次访问磁盘时加载"""
+        self.disk_size = 0
+        self.lock = threading.Lock()
+
+    def _path(self, key: str) -> pathlib.Path:
+        assert self.root is not None
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return self.root / digest[:2] / digest
+
+    def _load_index(self):
+        assert self.root is not None
+        self.root.mkdir(parents=True, exist_ok=True)
+        files = []
+        for path in self.root.glob("*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, path.name, stat.st_size))
+        files.sort()
+        self.index = OrderedDict((name, size) for _, name, size in files)
+        self.disk_size = sum(self.index.values())
+
+    def _remember(self, key: str, value: str):
+        if len(value) > self.memory_bytes:
+            return
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_size -= len(old)
+        self.memory[key] = value
+        self.memory_size += len(value)
+        while self.memory_size > self.memory_bytes:
+            _, dropped = self.memory.popitem(last=False)
+            self.memory_size -= len(dropped)
+
+    def _read(self, key: str) -> str | None:
+        with self.lock:
+            if self.index is None:
+                self._load_index()
+            assert self.index is not None
+            path = self._path(key)
+            if path.name not in self.index:
+                return None
+            try:
+                value = path.read_text(encoding="utf-8")
+                os.utime(path)
+            except OSError:
+                self.disk_size -= self.index.pop(path.name)
+                return None
+            self.index.move_to_end(path.name)
+            return value
+
+    def _write(self, key: str, value: str):
+        with self.lock:
+            if self.index is None:
+                self._load_index()
+            assert self.index is not None
+            path = self._path(key)
+            data = value.encode("utf-8")
+            if len(data) > self.max_bytes:
+                return
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+            self.disk_size += len(data) - self.index.pop(path.name, 0)
+            self.index[path.name] = len(data)
+            while self.disk_size > self.max_bytes and self.index:
+                name, size = self.index.popitem(last=False)
+                self.disk_size -= size
+                try:
+                    (self.root / name[:2] / name).unlink()  # type: ignore
+                except OSError:
+                    pass
+
+    async def get(self, key: str) -> str | None:
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory.move_to_end(key)
+            result = "memory"
+        elif self.root is not None:
+            try:
+                value = await asyncio.to_thread(self._read, key)
+            except Exception as ex:
+                logger.warning(f"读取图片缓存失败: {ex}")
+            if value is not None:
+                self._remember(key, value)
+                result = "disk"
+        if value is None:
+            METRICS.inc("chatgpt_vision_image_cache_total", result="miss")
+            return None
+        if value.startswith("@"):
+            return await self.get(value[1:])
+        METRICS.inc("chatgpt_vision_image_cache_total", result=result)
+        return value
+
+    async def set(self, key: str, value: str):
+        self._remember(key, value)
+        if self.root is None:
+            return
+        try:
+            await asyncio.to_thread(self._write, key, value)
+        except Exception as ex:
+            logger.warning(f"写入图片缓存失败: {ex}")
+
+    async def alias(self, key: str, target: str):
+        """让 key 指向 target 的内容"""
+        await self.set(key, "@" + target)
+
+
+IMAGE_CACHE = ImageCache(
+    p_config.image_cache_dir,
+    int(p_config.image_cache_size * 2**20),
+    int(p_config.image_cache_memory * 2**20),
+)
@@ -0,0 +1,134 @@
+"""
+图片处理函数，既在线程中调用，也作为独立的工作进程运行：
+
+    python -P image_worker.py
+
+工作进程从 stdin 读取请求、向 stdout 写入结果，每帧为 4 字节长度 + pickle 数据；
+作为脚本运行时不导入插件包，因此不能使用相对导入，只依赖 PIL 与 cairosvg
+"""
+
+import io
+import os
+import sys
+import pickle
+import cairosvg
+
+from PIL import Image
+
+
+class ImageTooLarge(ValueError):
+    """图片超过 image_max_bytes 或 image_max_pixels 的限制"""
+
+
+def _check_pixels(img: Image.Image, max_pixels: int):
+    if max_pixels > 0 and img.width * img.height > max_pixels:
+        raise ImageTooLarge(f"图片尺寸过大: {img.width}x{img.height}")
+
+
+def gif_to_png(content: bytes, max_pixels: int) -> bytes:
+    """GIF 取第一帧转为 PNG（在工作进程中执行）"""
+    with Image.open(io.BytesIO(content)) as img:
+        _check_pixels(img, max_pixels)
+        output = io.BytesIO()
+        img.convert("RGBA").save(output, format="PNG")
+        return output.getvalue()
+
+
+def svg_to_png(svg: bytes, max_pixels: int) -> bytes:
+    """渲染公式 SVG（在工作进程中执行）"""
+    png = cairosvg.svg2png(bytestring=svg, scale=2, background_color="#FFFBE6")
+    assert png is not None
+    with Image.open(io.BytesIO(png)) as img:
+        _check_pixels(img, max_pixels)
+    return png
+
+
+def dhash(content: bytes) -> int:
+    """64 位差值哈希（dHash），相似的图片哈希值的汉明距离很小（在工作进程中执行）"""
+    with Image.open(io.BytesIO(content)) as img:
+        img.draft("L", (64, 64))
+        small = img.convert("L").resize((9, 8), Image.Resampling.BILINEAR)
+        pixels = small.tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            i = row * 9 + col
+            value = value << 1 | (pixels[i] > pixels[i + 1])
+    return value
+
+
+_MIME = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+
+def shrink_image(
+    content: bytes, max_edge: int, fmt: str, quality: int, max_pixels: int
+) -> tuple[bytes, str]:
+    """
+    缩放到最长边不超过 max_edge 并重新编码（在工作进程中执行）
+
+    Returns:
+    --------
+    tuple[bytes, str]
+        图片数据与 MIME 类型；原图已足够小时原样返回
+    """
+    fmt = fmt.upper() if fmt.upper() in ("JPEG", "WEBP") else "JPEG"
+    with Image.open(io.BytesIO(content)) as img:
+        _check_pixels(img, max_pixels)
+        original = img.format or ""
+        resize = max(img.size) > max_edge
+        if not resize and original in ("JPEG", "WEBP"):
+            return content, _MIME[original]
+        # JPEG 可以直接按缩小的尺寸解码
+        img.draft("RGB", (max_edge, max_edge))
+        alpha = img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info
+        frame = img.convert("RGBA" if alpha else "RGB")
+    if resize:
+        frame.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    if fmt == "JPEG" and frame.mode == "RGBA":
+        background = Image.new("RGB", frame.size, (255, 255, 255))
+        background.paste(frame, mask=frame.getchannel("A"))
+        frame = background
+    output = io.BytesIO()
+    frame.save(output, format=fmt, quality=quality)
+    data = output.getvalue()
+    if not resize and len(data) >= len(content) and original in _MIME:
+        return content, _MIME[original]
+    return data, _MIME[fmt]
+
+
+FUNCTIONS = {f.__name__: f for f in (gif_to_png, svg_to_png, dhash, shrink_image)}
+
+
+def read_frame(stream) -> bytes | None:
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    size = int.from_bytes(header, "big")
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return data
+
+
+def write_frame(stream, data: bytes):
+    stream.write(len(data).to_bytes(4, "big") + data)
+    stream.flush()
+
+
+def serve():
+    """请求为 (函数名, 参数)，结果为 (True, 返回值) 或 (False, (异常类名, 信息))"""
+    stdin = sys.stdin.buffer
+    # 结果独占原来的 stdout，其他输出改到 stderr，避免混入协议
+    stdout = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    while (data := read_frame(stdin)) is not None:
+        name, args = pickle.loads(data)
+        try:
+            result = (True, FUNCTIONS[name](*args))
+        except Exception as ex:
+            result = (False, (type(ex).__name__, str(ex)))
+        write_frame(stdout, pickle.dumps(result, pickle.HIGHEST_PROTOCOL))
+
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,140 @@
+import sys
+import pickle
+import asyncio
+import pathlib
+
+from nonebot import logger, get_driver
+
+from .config import p_config
+from .image_worker import ImageTooLarge, gif_to_png, svg_to_png, dhash, shrink_image
+
+WORKER_SCRIPT = pathlib.Path(__file__).with_name("image_worker.py")
+
+
+def max_bytes() -> int:
+    return int(p_config.image_max_bytes * 2**20)
+
+
+class WorkerPool:
+    """
+    图片处理工作进程池
+
+    工作进程以 python -P image_worker.py 启动，而不是 fork 或 multiprocessing：
+    不会继承主进程中其他线程持有的锁，也不会在子进程中重新执行主模块、导入插件。
+    进程在首次使用时启动，之后常驻复用
+    """
+
+    def __init__(self, size: int):
+        self.loop = asyncio.get_running_loop()
+        self.semaphore = asyncio.Semaphore(size)
+        self.idle: list[asyncio.subprocess.Process] = []
+        self.procs: set[asyncio.subprocess.Process] = set()
+
+    async def _spawn(self) -> asyncio.subprocess.Process:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-P",
+            str(WORKER_SCRIPT),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            limit=2**20,
+        )
+        self.procs.add(proc)
+        return proc
+
+    def _kill(self, proc: asyncio.subprocess.Process):
+        self.procs.discard(proc)
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    async def _call(proc: asyncio.subprocess.Process, name: str, args: tuple):
+        assert proc.stdin is not None and proc.stdout is not None
+        data = pickle.dumps((name, args), pickle.HIGHEST_PROTOCOL)
+        proc.stdin.write(len(data).to_bytes(4, "big") + data)
+        await proc.stdin.drain()
+        header = await proc.stdout.readexactly(4)
+        return pickle.loads(
+            await proc.stdout.readexactly(int.from_bytes(header, "big"))
+        )
+
+    async def run(self, func, *args):
+        async with self.semaphore:
+            proc = self.idle.pop() if self.idle else await self._spawn()
+            try:
+                ok, value = await self._call(proc, func.__name__, args)
+            except BaseException as ex:
+                # 被取消或进程异常退出（例如内存不足被杀）时，之后的响应无法与请求对应，
+                # 直接结束这个进程，下次使用时重新启动
+                self._kill(proc)
+                if isinstance(ex, (asyncio.IncompleteReadError, ConnectionError)):
+                    logger.warning("图片处理进程异常退出，将重新启动")
+                    raise RuntimeError("图片处理进程异常退出") from ex
+                raise
+            self.idle.append(proc)
+        if ok:
+            return value
+        name, message = value
+        if name == ImageTooLarge.__name__:
+            raise ImageTooLarge(message)
+        raise RuntimeError(f"{name}: {message}")
+
+    def shutdown(self):
+        for proc in list(self.procs):
+            self._kill(proc)
+        self.idle.clear()
+
+
+_POOL: WorkerPool | None = None
+
+
+async def run_image_task(func, *args):
+    """
+    在工作进程中执行 image_worker 中的 func(*args)，不阻塞事件循环；
+    image_workers 为 0 或平台不支持子进程时在线程中执行
+    """
+    global _POOL
+    if p_config.image_workers > 0:
+        if _POOL is not None and _POOL.loop is not asyncio.get_running_loop():
+            # 进程的管道属于创建它们的事件循环
+            shutdown_image_pool()
+        if _POOL is None:
+            _POOL = WorkerPool(p_config.image_workers)
+        try:
+            return await _POOL.run(func, *args)
+        except NotImplementedError:
+            # 例如 Windows 上的 SelectorEventLoop 不支持子进程
+            logger.warning("当前事件循环不支持子进程，图片处理改为在线程中执行")
+            p_config.image_workers = 0
+    return await asyncio.to_thread(func, *args)
+
+
+async def read_limited(
+    response, limit: int, buffer: bytearray | None = None, aiter=None
+) -> bytes:
+    """
+    读取响应体，超过 limit 字节时立即中止下载
+
+    buffer 与 aiter 用于接着已经读取的部分继续读取
+    """
+    length = response.headers.get("Content-Length")
+    if limit > 0 and length and length.isdigit() and int(length) > limit:
+        raise ImageTooLarge(f"图片过大: {int(length)} 字节")
+    buffer = buffer if buffer is not None else bytearray()
+    async for chunk in aiter or response.aiter_bytes():
+        buffer.extend(chunk)
+        if limit > 0 and len(buffer) > limit:
+            raise ImageTooLarge(f"图片超过 {limit} 字节，已中止下载")
+    return bytes(buffer)
+
+
+def shutdown_image_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.shutdown()
+    _POOL = None
+
+
+get_driver().on_shutdown(shutdown_image_pool)
@@ -0,0 +1,183 @@
+import hmac
+import math
+
+from typing import Any
+from bisect import bisect_left
+from nonebot import logger
+from nonebot import get_driver
+from nonebot.drivers import URL, ASGIMixin, HTTPServerSetup, Request, Response
+
+from .config import p_config
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+HELP = {
+    "chatgpt_vision_requests_total": ("counter", "LLM 请求次数"),
+    "chatgpt_vision_request_errors_total": ("counter", "LLM 请求失败次数"),
+    "chatgpt_vision_request_seconds": ("histogram", "LLM 请求耗时（秒）"),
+    "chatgpt_vision_first_paragraph_seconds": (
+        "histogram",
+        "从开始生成到发出第一段的耗时（秒）",
+    ),
+    "chatgpt_vision_tokens_total": ("counter", "LLM 消耗的 token 数"),
+    "chatgpt_vision_replies_total": ("counter", "回复次数，null 表示模型选择不回复"),
+    "chatgpt_vision_tool_calls_total": ("counter", "工具调用次数"),
+    "chatgpt_vision_tool_seconds": ("histogram", "工具调用耗时（秒）"),
+    "chatgpt_vision_bad_images_total": ("counter", "因无法访问被移除的图片数"),
+    "chatgpt_vision_image_dedup_total": ("counter", "因重复而未发送的图片数"),
+    "chatgpt_vision_image_aged_total": ("counter", "因过旧而替换为描述的图片数"),
+    "chatgpt_vision_image_cache_total": (
+        "counter",
+        "图片缓存查询次数，result 为 memory/disk 命中或 miss",
+    ),
+}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """进程内的计数器与直方图，按 Prometheus 文本格式导出"""
+
+    def __init__(self):
+        self.counters: dict[str, dict[tuple, float]] = {}
+        self.histograms: dict[str, dict[tuple, Histogram]] = {}
+
+    @staticmethod
+    def _labels(labels: dict[str, Any]) -> tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = self._labels(labels)
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = self._labels(labels)
+        if key not in series:
+            series[key] = Histogram()
+        series[key].observe(value)
+
+    def get(self, name: str, **labels) -> float:
+        """按标签子集汇总计数器"""
+        want = set(self._labels(labels))
+        return sum(v for k, v in self.counters.get(name, {}).items() if want <= set(k))
+
+    def render(self) -> str:
+        def fmt(labels: tuple, extra: tuple = ()) -> str:
+            items = labels + extra
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+        lines: list[str] = []
+        for name, series in self.counters.items():
+            kind, doc = HELP.get(name, ("counter", name))
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in series.items():
+                lines.append(f"{name}{fmt(labels)} {value:g}")
+        for name, series in self.histograms.items():
+            kind, doc = HELP.get(name, ("histogram", name))
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, h in series.items():
+                total = 0
+                for bound, count in zip(h.buckets + (math.inf,), h.counts):
+                    total += count
+                    le = "+Inf" if bound == math.inf else f"{bound:g}"
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', le),))} {total}")
+                lines.append(f"{name}_sum{fmt(labels)} {h.sum:g}")
+                lines.append(f"{name}_count{fmt(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> list[dict[str, Any]]:
+        """按群、模型汇总请求数、平均耗时与 token 用量"""
+        ret: dict[tuple[str, str], dict[str, Any]] = {}
+        for labels, h in self.histograms.get(
+            "chatgpt_vision_request_seconds", {}
+        ).items():
+            d = dict(labels)
+            key = (d.get("group", ""), d.get("model", ""))
+            ret[key] = {
+                "group": key[0],
+                "model": key[1],
+                "requests": h.count,
+                "latency": h.sum / h.count if h.count else 0.0,
+                "errors": self.get(
+                    "chatgpt_vision_request_errors_total", group=key[0], model=key[1]
+                ),
+            }
+            for kind in ("prompt", "completion", "cached"):
+                ret[key][kind] = self.get(
+                    "chatgpt_vision_tokens_total", group=key[0], model=key[1], kind=kind
+                )
+        return sorted(ret.values(), key=lambda x: -(x["prompt"] + x["completion"]))
+
+
+METRICS = Metrics()
+
+
+def record_usage(usage: Any, **labels):
+    """记录响应中的 usage"""
+    if not usage:
+        return
+    METRICS.inc(
+        "chatgpt_vision_tokens_total", usage.prompt_tokens or 0, kind="prompt", **labels
+    )
+    METRICS.inc(
+        "chatgpt_vision_tokens_total",
+        usage.completion_tokens or 0,
+        kind="completion",
+        **labels,
+    )
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None) if details else None
+    if cached:
+        METRICS.inc("chatgpt_vision_tokens_total", cached, kind="cached", **labels)
+
+
+async def _metrics_handler(request: Request) -> Response:
+    token = request.url.query.get("token") or request.headers.get(
+        "Authorization", ""
+    ).removeprefix("Bearer ")
+    if not hmac.compare_digest(token.encode(), p_config.metrics_token.encode()):
+        return Response(403, content="Forbidden")
+    return Response(
+        200,
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        content=METRICS.render(),
+    )
+
+
+driver = get_driver()
+if p_config.metrics_path:
+    if not p_config.metrics_token:
+        # 指标中含有群号与 token 用量，不允许无鉴权暴露
+        logger.warning("未设置 metrics_token，metrics 路由未启用")
+    elif isinstance(driver, ASGIMixin):
+        driver.setup_http_server(
+            HTTPServerSetup(
+                URL(p_config.metrics_path),
+                "GET",
+                "chatgpt_vision_metrics",
+                _metrics_handler,
+            )
+        )
+    else:
+        logger.warning("当前驱动器不支持 HTTP 服务，metrics 路由未启用")
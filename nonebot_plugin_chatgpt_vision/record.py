@@ -1,14 +1,18 @@
+import sys
+import json
 import yaml
 import bisect
 import httpx
 import asyncio
 
+from enum import Enum
 from lxml import etree
 from typing import Any, Optional
 from nonebot import logger
 from datetime import datetime
 from functools import partial
-from collections.abc import Iterable
+from collections import deque
+from collections.abc import Awaitable, Iterable, Iterator
 from nonebot.adapters.onebot.v11.message import Message as V11Msg
 from nonebot.adapters.onebot.v11.message import MessageSegment as V11Seg
 
@@ -16,9 +20,13 @@ from .utils import (
     QFACE,
     check_url_status,
     convert_gif_to_png_base64,
+    estimate_tokens,
     correct_tencent_image_url,
 )
 from .config import p_config
+from .caption import image_caption
+from .image_cache import PHASH_DISTANCE, image_key, image_phash
+from .client import get_http_client
 
 
 async def v11msg_to_xml_async(msg: V11Msg, msg_id: str | None) -> tuple[str, list[str]]:
@@ -46,7 +54,8 @@ async def v11msg_to_xml_async(msg: V11Msg, msg_id: str | None) -> tuple[str, lis
     if msg_id is not None:
         p.set("msgid", msg_id)
 
-    images: list[str] = []
+    # 图片统一在最后并发转换，保持原有顺序
+    pending: list[Awaitable[str]] = []
 
     for seg in msg:
         st = seg.type
@@ -84,16 +93,17 @@ async def v11msg_to_xml_async(msg: V11Msg, msg_id: str | None) -> tuple[str, lis
             file_ = data.get("url")
             image = etree.SubElement(p, "image")
             if file_:
-                url = await convert_gif_to_png_base64(correct_tencent_image_url(file_))
                 image.set("url", file_)
-                images.append(url)
+                pending.append(
+                    convert_gif_to_png_base64(correct_tencent_image_url(file_))
+                )
 
         elif st == "mface":
             image = etree.SubElement(p, "image")
             file_ = data.get("url")
             if file_:
                 image.set("url", file_)
-                images.append(await convert_gif_to_png_base64(file_))
+                pending.append(convert_gif_to_png_base64(file_))
 
             summary = data.get("summary", "")
             if (
@@ -112,15 +122,41 @@ async def v11msg_to_xml_async(msg: V11Msg, msg_id: str | None) -> tuple[str, lis
             _append_text(p, f"[{st}]")
 
     xml_str = etree.tostring(p, encoding="unicode")
+    images = list(await asyncio.gather(*pending))
 
     return xml_str, images
 
 
+class RecordKind(Enum):
+    USER = "user"
+    """群聊中的消息"""
+    ASSISTANT = "assistant"
+    """机器人生成的回复"""
+    TOOL_CALLS = "tool_calls"
+    """机器人发起的工具调用（可能同时带有回复内容）"""
+    TOOL = "tool"
+    """工具调用的结果"""
+
+
 class RecordSeg:
+    __slots__ = (
+        "name",
+        "uid",
+        "msg",
+        "time",
+        "reply",
+        "images",
+        "kind",
+        "tool_calls",
+        "_tokens",
+        "_message",
+        "_saved",
+    )
+
     name: str
     uid: str
     msg: list[tuple[str, str]]
-    """富文本 XML 消息，或yaml存储的内容
+    """(消息 ID, 富文本 XML) 列表，机器人回复的 ID 为 content，工具结果的 ID 为调用 ID
 
     Example:
     <p msgid="1234567890">你好<mention uid="123456789">苦咖啡</mention>！</p>
@@ -131,6 +167,10 @@ class RecordSeg:
 
     reply: Optional["RecordSeg"]
     images: list[str]
+    """本条消息自身的图片，引用消息的图片通过 reply 共享，见 all_images"""
+    kind: RecordKind
+    tool_calls: list[dict[str, Any]] | None
+    """OpenAI 格式的工具调用，仅 TOOL_CALLS 记录有"""
 
     def __init__(
         self,
@@ -141,26 +181,172 @@ class RecordSeg:
         time: datetime,
         images: list[str] = [],
         reply: Optional["RecordSeg"] = None,
+        kind: RecordKind | None = None,
+        tool_calls: list[dict[str, Any]] | None = None,
     ):
         if images:
             self.images = images
         else:
             self.images = []
-        self.name = name
-        self.uid = uid
+        if kind is None:
+            kind = RecordKind.TOOL if uid == "tool" else RecordKind.USER
+        self.kind = kind
+        self.tool_calls = tool_calls or None
+        # 同一用户的名字与 ID 在大量记录中重复出现
+        self.name = sys.intern(str(name))
+        self.uid = sys.intern(str(uid))
         self.msg = []
+        if kind == RecordKind.TOOL and isinstance(msg, list):
+            # 工具返回的内容块：文本作为消息，图片放入 images
+            texts = []
+            for part in msg:
+                if part.get("type") == "image_url":
+                    self.images.append(part["image_url"]["url"])
+                else:
+                    texts.append(str(part.get("text", "")))
+            msg = "\n".join(texts)
         if isinstance(msg, str):
             self.msg.append((str(msg_id), msg))
         else:
             raise ValueError("msg must be a string")
         self.time = time
         self.reply = reply
-        if reply and reply.images:
-            self.images = reply.images + self.images
+        self._tokens: int | None = None
+        self._message: tuple[tuple[str, bool, int], dict[str, Any]] | None = None
+        # 自上次增量保存后是否未被修改，见 storage.journal
+        self._saved = False
 
     def __str__(self):
         return self.to_str(with_title=True)
 
+    def __getstate__(self):
+        # 缓存不参与持久化
+        state = {k: getattr(self, k) for k in self.__slots__ if not k.startswith("_")}
+        state["kind"] = self.kind.value
+        if not self.tool_calls:
+            del state["tool_calls"]
+        return state
+
+    def __setstate__(self, state: dict):
+        self.name = sys.intern(str(state.get("name") or ""))
+        self.uid = sys.intern(str(state.get("uid") or ""))
+        self.msg = state.get("msg") or []
+        self.tool_calls = state.get("tool_calls") or None
+        if "kind" in state:
+            self.kind = RecordKind(state["kind"])
+        else:
+            # 旧数据：机器人的回复以 ("content", xml) 与 ("tool_calls", yaml) 存在 msg 中
+            ids = [mid for mid, _ in self.msg]
+            if self.uid == "tool":
+                self.kind = RecordKind.TOOL
+            elif "tool_calls" in ids:
+                self.kind = RecordKind.TOOL_CALLS
+                self.tool_calls = []
+                for mid, value in self.msg:
+                    if mid == "tool_calls":
+                        self.tool_calls += yaml.safe_load(value) or []
+                self.msg = [m for m in self.msg if m[0] != "tool_calls"]
+            elif "content" in ids:
+                self.kind = RecordKind.ASSISTANT
+            else:
+                self.kind = RecordKind.USER
+        self.time = state.get("time") or datetime.now()
+        self.reply = state.get("reply")
+        images = state.get("images") or []
+        # 旧数据把引用消息的图片复制到了 images 开头
+        if self.reply and self.reply.images:
+            quoted = set(self.reply.images)
+            start = 0
+            while start < len(images) and images[start] in quoted:
+                start += 1
+            images = images[start:]
+        self.images = images
+        self._tokens = None
+        self._message = None
+        self._saved = False
+
+    @property
+    def all_images(self) -> list[str]:
+        """引用消息的图片在前，其后是本条消息的图片"""
+        if self.reply and self.reply.images:
+            return self.reply.images + self.images
+        return self.images
+
+    def touch(self):
+        """消息内容被修改后调用，使缓存失效"""
+        self._tokens = None
+        self._message = None
+        self._saved = False
+
+    def tokens(self, image_mode: bool = False) -> int:
+        """估算该条记录占用的 token 数，文本部分会被缓存"""
+        text_tokens = self._tokens
+        if text_tokens is None:
+            text_tokens = estimate_tokens(self.to_str(with_title=True))
+            if self.tool_calls:
+                text_tokens += estimate_tokens(
+                    json.dumps(self.tool_calls, ensure_ascii=False)
+                )
+            self._tokens = text_tokens
+        if image_mode:
+            return text_tokens + len(self.all_images) * p_config.image_tokens
+        return text_tokens
+
+    def message(
+        self,
+        bot_uid: str,
+        image_mode: bool = False,
+        low_detail: int = 0,
+        replaced: tuple[tuple[int, str], ...] = (),
+    ) -> dict[str, Any]:
+        """
+        渲染为 OpenAI 消息，结果会被缓存直至 touch()
+        图片的处理方式见 content()
+
+        返回的字典在多次调用间共享，不要修改它
+        """
+        view = (bot_uid, image_mode, low_detail, replaced)
+        cached = self._message
+        if cached and cached[0] == view:
+            return cached[1]
+        data: dict[str, Any]
+        if self.kind == RecordKind.TOOL:
+            if not self.name:
+                logger.warning("Tool record without name")
+                self.name = "unknown_tool"
+            content = "".join(m[1] for m in self.msg)
+            # tool 消息只能包含文本，图片由 RecordList.message 放在随后的 user 消息中
+            if self.images:
+                content += (
+                    f"\n[工具返回了 {len(self.images)} 张图片，见随后的消息]"
+                    if image_mode
+                    else f"\n[工具返回了 {len(self.images)} 张图片]"
+                )
+            data = {
+                "role": "tool",
+                "name": self.name,
+                "content": content,
+            }
+        elif self.kind != RecordKind.USER or self.uid == bot_uid:
+            data = {"role": "assistant"}
+            content = "".join(m[1] for m in self.msg)
+            if content or not self.tool_calls:
+                data["content"] = content
+            if self.tool_calls:
+                data["tool_calls"] = self.tool_calls
+        else:
+            data = {
+                "role": "user",
+                "content": self.content(
+                    with_title=True,
+                    image_mode=image_mode,
+                    low_detail=low_detail,
+                    replaced=replaced,
+                ),
+            }
+        self._message = (view, data)
+        return data
+
     def to_str(
         self,
         with_title: bool = False,
@@ -184,10 +370,21 @@ class RecordSeg:
             ret + "".join(m[1] for m in self.msg) + ("</message>" if with_title else "")
         )
 
-    def content(self, with_title: bool = False, image_mode: bool = False) -> list | str:
+    def content(
+        self,
+        with_title: bool = False,
+        image_mode: bool = False,
+        low_detail: int = 0,
+        replaced: tuple[tuple[int, str], ...] = (),
+    ) -> list | str:
+        """
+        image_mode 时附带图片：replaced 中的（序号, 文字）把对应的图片替换为文字，
+        其余图片中的前 low_detail 张使用 detail: low
+        """
         if not image_mode:
             return self.to_str(with_title)
-        if not self.images:
+        images = self.all_images
+        if not images:
             return self.to_str(with_title)
         ret: list[dict[str, Any]] = [
             {
@@ -195,54 +392,120 @@ class RecordSeg:
                 "text": self.to_str(with_title),
             }
         ]
-        for i in self.images:
+        texts = dict(replaced)
+        for n, i in enumerate(images):
+            if n in texts:
+                ret.append({"type": "text", "text": texts[n]})
+                continue
             ret.append(
                 {
                     "type": "image_url",
-                    "image_url": {
-                        "url": i,
-                    },
+                    "image_url": (
+                        {"url": i, "detail": "low"} if low_detail > 0 else {"url": i}
+                    ),
                 }
             )
+            low_detail -= 1
         return ret
 
 
 class RecordList:
-    records: list[RecordSeg]
+    records: deque[RecordSeg]
     merge: bool
     """是否合并相同用户的连续消息"""
 
-    def __init__(self, merge: bool = True, records: list[RecordSeg] = []):
-        if not records:
-            records = []
-        self.records = records
+    saved_images: int
+    """上次 message() 因去重而未发送的图片数"""
+    aged_images: list[str]
+    """上次 message() 因过旧而替换为描述的图片"""
+
+    FIELDS = ("content",)
+    """机器人回复在 msg 中使用的 ID，不是消息 ID，不参与索引"""
+
+    def __init__(self, merge: bool = True, records: Iterable[RecordSeg] = ()):
+        self.records = deque()
+        self.saved_images = 0
+        self.aged_images = []
+        self._ids: dict[str, list[RecordSeg]] = {}
         self.merge = merge
+        for record in records:
+            self.records.append(record)
+            self._index(record, record)
+
+    def __getstate__(self):
+        return {"records": list(self.records), "merge": self.merge}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state.get("merge", True), state.get("records") or ())
+
+    def _index(self, record: RecordSeg, target: RecordSeg):
+        """把 record 中的消息 ID 指向 target"""
+        for mid, _ in record.msg:
+            if mid not in self.FIELDS:
+                self._ids.setdefault(mid, []).append(target)
+
+    def _unindex(self, record: RecordSeg):
+        for mid, _ in record.msg:
+            refs = self._ids.get(mid)
+            if refs is None:
+                continue
+            refs[:] = [r for r in refs if r is not record]
+            if not refs:
+                del self._ids[mid]
 
-    def add(self, record: RecordSeg):
-        index = bisect.bisect_right(self.records, record.time, key=lambda r: r.time)
+    def _insert(self, index: int, record: RecordSeg) -> RecordSeg:
+        if index == len(self.records):
+            self.records.append(record)
+        else:
+            self.records.insert(index, record)
+        self._index(record, record)
+        return record
+
+    def _pop(self, index: int) -> RecordSeg:
+        if index == 0:
+            record = self.records.popleft()
+        else:
+            record = self.records[index]
+            del self.records[index]
+        self._unindex(record)
+        return record
+
+    def add(self, record: RecordSeg) -> RecordSeg:
+        """
+        按时间插入一条消息
+
+        Returns:
+        --------
+        RecordSeg
+            消息最终所在的记录（合并时为前一条记录）
+        """
+        # 绝大多数消息按时间顺序到达，直接追加到末尾
+        if not self.records or record.time >= self.records[-1].time:
+            index = len(self.records)
+        else:
+            index = bisect.bisect_right(self.records, record.time, key=lambda r: r.time)
         # 判断是否需要合并
         if not self.merge:
-            self.records.insert(index, record)
-            return
+            return self._insert(index, record)
         # 如果有引用消息，不合并
         if record.reply:
-            self.records.insert(index, record)
-            return
-        # 工具不需要合并
-        if record.uid == "tool":
-            self.records.insert(index, record)
-            return
+            return self._insert(index, record)
+        # 只合并群聊消息，机器人的回复、工具调用与结果保持独立
+        if record.kind != RecordKind.USER:
+            return self._insert(index, record)
         # 插入到最前面
         if index == 0:
-            self.records.insert(index, record)
-            return
+            return self._insert(index, record)
         # 合并到前一条
-        if record.uid != self.records[index - 1].uid:
-            self.records.insert(index, record)
-            return
-        self.records[index - 1].msg.extend(record.msg)
-        self.records[index - 1].images.extend(record.images)
-        self.records[index - 1].time = record.time
+        prev = self.records[index - 1]
+        if record.uid != prev.uid or prev.kind != RecordKind.USER:
+            return self._insert(index, record)
+        prev.msg.extend(record.msg)
+        prev.images.extend(record.images)
+        prev.time = record.time
+        prev.touch()
+        self._index(record, prev)
+        return prev
 
     def extend(self, records: Iterable[RecordSeg]):
         for record in records:
@@ -256,61 +519,174 @@ class RecordList:
     ) -> bool:
         if not delete_time:
             delete_time = datetime.now()
-        for record in self.records:
+        key = str(msg_id)
+        for record in self._ids.get(key, ()):
             if user_id and record.uid != user_id:
                 continue
             for j, (mid, _) in enumerate(record.msg):
-                if mid == str(msg_id):
+                if mid == key:
                     record.msg[j] = (
                         mid,
                         f"<p>[DELETE at {delete_time.strftime('%Y-%m-%d %H:%M %a')}]</p>",
                     )
+                    record.touch()
                     return True
         return False
 
-    def message(self, bot_uid: str, image_mode: bool = False) -> list[dict]:
+    def message(
+        self,
+        bot_uid: str,
+        image_mode: bool = False,
+        full_detail: int = 0,
+        dedup: bool = False,
+        keep_images: int = 0,
+        keep_records: int = 0,
+    ) -> list[dict]:
+        """
+        渲染全部记录
+
+        full_detail > 0 时只有最近的 full_detail 张图片保持原始细节；
+        dedup 时窗口内重复的图片只发送最后一次出现的，更早的替换为指向它的文字说明，
+        省下的图片数记录在 saved_images；
+        keep_images 或 keep_records > 0 时，只有最近的 keep_images 张图片与
+        最近 keep_records 条记录中的图片以图片发送，更早的替换为图片描述，
+        这些图片记录在 aged_images
+        """
+        self.saved_images = 0
+        self.aged_images = []
+        aging = keep_images > 0 or keep_records > 0
+        if not image_mode or (full_detail <= 0 and not dedup and not aging):
+            out = [r.message(bot_uid, image_mode) for r in self.records]
+            return self._with_tool_images(out) if image_mode else out
+        duplicates = self._duplicate_images() if dedup else {}
+        out = []
+        # 从新到旧已经以图片发送的数量
+        sent = 0
+        for age, r in enumerate(reversed(self.records)):
+            images = r.all_images if r.kind == RecordKind.USER else None
+            if not images:
+                out.append(r.message(bot_uid, image_mode))
+                continue
+            replaced = dict(duplicates.get(id(r), ()))
+            quoted = len(images) - len(r.images)
+            self.saved_images += len(replaced)
+            low = 0
+            for n in range(len(images) - 1, -1, -1):
+                if n in replaced:
+                    continue
+                if aging and sent >= keep_images and age >= keep_records:
+                    caption = image_caption(images[n])
+                    if not caption:
+                        owner = r.reply if n < quoted and r.reply else r
+                        caption = f"{owner.name} 发送的较早的图片"
+                    replaced[n] = f"[图片：{caption}]"
+                    self.aged_images.append(images[n])
+                    continue
+                if full_detail > 0 and sent >= full_detail:
+                    low += 1
+                sent += 1
+            out.append(
+                r.message(bot_uid, image_mode, low, tuple(sorted(replaced.items())))
+            )
+        out.reverse()
+        return self._with_tool_images(out)
+
+    def _with_tool_images(self, out: list[dict]) -> list[dict]:
+        """
+        把工具返回的图片作为 user 消息插入到连续的 tool 消息之后
+
+        out 与 records 一一对应；tool 消息必须紧跟在 tool_calls 之后，不能插在它们中间
+        """
+        if not any(r.kind == RecordKind.TOOL and r.images for r in self.records):
+            return out
+        records = list(self.records)
         ret = []
-        for record in self.records:
-            if record.uid == bot_uid:
-                data: dict[str, Any] = {
-                    "role": "assistant",
-                }
-                for id, value in record.msg:
-                    if id == "content":
-                        data[id] = value
-                    else:
-                        data[id] = yaml.safe_load(value)
-                ret.append(data)
+        images: list[str] = []
+        for i, (r, data) in enumerate(zip(records, out)):
+            ret.append(data)
+            if r.kind != RecordKind.TOOL:
                 continue
-            if record.uid == "tool":
-                id, content = record.msg[0]
-                if not record.name:
-                    logger.warning("Tool record without name")
-                    record.name = "unknown_tool"
+            images += r.images
+            last = i + 1 == len(records) or records[i + 1].kind != RecordKind.TOOL
+            if last and images:
                 ret.append(
                     {
-                        "role": "tool",
-                        "name": record.name,
-                        "content": content,
-                        # "id": id,
+                        "role": "user",
+                        "content": [{"type": "text", "text": "工具返回的图片："}]
+                        + [
+                            {"type": "image_url", "image_url": {"url": url}}
+                            for url in images
+                        ],
                     }
                 )
-                continue
-            ret.append(
-                {
-                    "role": "user",
-                    "content": record.content(with_title=True, image_mode=image_mode),
-                }
-            )
+                images = []
         return ret
 
+    def _duplicate_images(self) -> dict[int, tuple[tuple[int, str], ...]]:
+        """
+        找出窗口内重复的图片（相同的文件，或感知哈希相近）
+
+        保留最后一次出现的：较新的图片最不容易因 keep_images 被替换为描述，
+        保留最早的会让近期转发的图片指向一条已被替换的描述
+
+        Returns:
+        --------
+        dict[int, tuple[tuple[int, str], ...]]
+            id(record) -> 重复图片的（序号, 指向最后一次出现的文字说明）
+        """
+        seen: dict[str, str] = {}
+        hashes: list[tuple[int, str]] = []
+        duplicates: dict[int, tuple[tuple[int, str], ...]] = {}
+        for r in reversed(self.records):
+            if r.kind != RecordKind.USER:
+                continue
+            images = r.all_images
+            if not images:
+                continue
+            quoted = len(images) - len(r.images)
+            found = []
+            for n in range(len(images) - 1, -1, -1):
+                url = images[n]
+                key = image_key(url)
+                phash = image_phash(url)
+                text = seen.get(key)
+                if text is None and phash is not None:
+                    text = next(
+                        (
+                            t
+                            for h, t in hashes
+                            if (h ^ phash).bit_count() <= PHASH_DISTANCE
+                        ),
+                        None,
+                    )
+                if text is not None:
+                    found.append((n, text))
+                    continue
+                # 引用的图片随这条消息再次发送，指向引用它的消息
+                when = r.time.strftime("%m-%d %H:%M")
+                action = "引用" if n < quoted else "发送"
+                text = f"[重复的图片，同 {r.name} {when} {action}的图片]"
+                seen[key] = text
+                if phash is not None:
+                    hashes.append((phash, text))
+            if found:
+                duplicates[id(r)] = tuple(sorted(found))
+        return duplicates
+
+    def tokens(self, image_mode: bool = False) -> int:
+        """估算全部记录占用的 token 数"""
+        return sum(r.tokens(image_mode) for r in self.records)
+
     def __len__(self):
         return len(self.records)
 
     def __getitem__(self, index: int) -> RecordSeg:
         return self.records[index]
 
-    def remove(self, index: int, ensure_correct: bool = True) -> None:
+    def __iter__(self) -> Iterator[RecordSeg]:
+        return iter(self.records)
+
+    def remove(self, index: int, ensure_correct: bool = True) -> list[RecordSeg]:
         """
         移除指定位置的消息，并确保上下文是符合相对应的要求。（例如TOOL CALL必须在用户消息之后之类的）
 
@@ -324,51 +700,62 @@ class RecordList:
 
         Returns:
         --------
-        Iterable[RecordSeg]
+        list[RecordSeg]
             被移除的消息列表
         """
         if index >= len(self.records):
             raise IndexError("RecordList index out of range")
         index %= len(self.records)
-        self.records.pop(index)
+        removed = [self._pop(index)]
         if not ensure_correct or len(self.records) == 1:
-            return
-        while len(self.records) > 0 and self.records[0].uid == "tool":
-            self.records.pop(0)
+            return removed
+        while len(self.records) > 0 and self.records[0].kind == RecordKind.TOOL:
+            removed.append(self._pop(0))
         if index == 0:
-            is_tool_call = False
-            for id, _ in self.records[0].msg:
-                if id == "tool_calls":
-                    is_tool_call = True
-                    break
-            if is_tool_call:
-                self.remove(0, ensure_correct=True)
-            return
-
-        while index < len(self.records):
-            if self.records[index].uid == "tool":
-                self.records.pop(index)
-
-    async def remove_bad_images(self):
+            if self.records and self.records[0].kind == RecordKind.TOOL_CALLS:
+                removed += self.remove(0, ensure_correct=True)
+            return removed
+
+        # 被移除消息之后的工具结果已失去对应的调用
+        while index < len(self.records) and self.records[index].kind == RecordKind.TOOL:
+            removed.append(self._pop(index))
+        return removed
+
+    async def remove_bad_images(self) -> int:
         """
         移除所有无法访问的图片，并且给rkey参数添加最新的值
+
+        Returns:
+        --------
+        int
+            被移除的图片数量
         """
 
-        async def _(r: RecordSeg, client: httpx.AsyncClient):
-            r.images = list(
-                filter(
-                    None,
-                    await asyncio.gather(
-                        *map(
-                            partial(check_url_status, client=client),
-                            map(correct_tencent_image_url, r.images),
-                        )
-                    ),
+        async def _(r: RecordSeg, client: httpx.AsyncClient) -> int:
+            removed = 0
+            # 引用消息的图片也要检查，它们由 reply 持有
+            for owner in (r, r.reply):
+                if not owner or not owner.images:
+                    continue
+                images = list(
+                    filter(
+                        None,
+                        await asyncio.gather(
+                            *map(
+                                partial(check_url_status, client=client),
+                                map(correct_tencent_image_url, owner.images),
+                            )
+                        ),
+                    )
                 )
-            )
-
-        async with httpx.AsyncClient(proxy=p_config.tool_proxy_url) as client:
-            await asyncio.gather(*map(partial(_, client=client), self.records))
+                if images != owner.images:
+                    removed += len(owner.images) - len(images)
+                    owner.images = images
+                    r.touch()
+            return removed
+
+        client = get_http_client()
+        return sum(await asyncio.gather(*map(partial(_, client=client), self.records)))
 
 
 XML_PROMPT = (
@@ -0,0 +1,368 @@
+import time
+import random
+import openai
+
+from collections import deque
+
+from typing import Any
+from nonebot import logger
+
+from .config import p_config
+
+
+class UpstreamError(Exception):
+    """所有候选端点都失败（或熔断）时抛出，表示上游暂时不可用"""
+
+    def __init__(self, model: str, last_error: Exception | None = None):
+        self.model = model
+        self.last_error = last_error
+        super().__init__(
+            f"模型 {model} 的所有端点均不可用"
+            + (f"：{last_error}" if last_error else "")
+        )
+
+
+class EmptyResponse(ValueError):
+    """上游返回了空响应"""
+
+
+def is_transient(ex: BaseException) -> bool:
+    """判断异常是否为上游的暂时性故障（超时、连接失败、429、5xx 等）"""
+    if isinstance(ex, (UpstreamError, EmptyResponse)):
+        return True
+    if isinstance(ex, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(ex, openai.APIStatusError):
+        return ex.status_code in (408, 409, 429) or ex.status_code >= 500
+    return False
+
+
+def retry_after(ex: BaseException) -> float | None:
+    """从 429/503 响应中读取 Retry-After（秒）"""
+    response = getattr(ex, "response", None)
+    if response is None:
+        return None
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class EndpointHealth:
+    """单个端点（base_url + key）的健康状态与熔断器"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = self.CLOSED
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.error_rate = 0.0
+        """错误率的指数滑动平均"""
+        self.latency: float | None = None
+        """延迟（秒）的指数滑动平均"""
+        self.opened_at = 0.0
+        self.last_error = ""
+        self.probing = False
+
+    def available(self, now: float | None = None) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = now or time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < p_config.router_open_seconds:
+                return False
+            self.state = self.HALF_OPEN
+            self.probing = False
+        # 半开状态只放行一个探测请求
+        return not self.probing
+
+    def begin(self):
+        if self.state == self.HALF_OPEN:
+            self.probing = True
+
+    def record_success(self, latency: float):
+        alpha = p_config.router_ewma_alpha
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.error_rate *= 1 - alpha
+        self.latency = (
+            latency
+            if self.latency is None
+            else self.latency * (1 - alpha) + latency * alpha
+        )
+        if self.state != self.CLOSED:
+            logger.info(f"端点 {self.name} 已恢复")
+        self.state = self.CLOSED
+        self.probing = False
+
+    def record_failure(self, ex: BaseException):
+        alpha = p_config.router_ewma_alpha
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = self.error_rate * (1 - alpha) + alpha
+        self.last_error = f"{type(ex).__name__}: {ex}"[:200]
+        self.probing = False
+        if self.state == self.HALF_OPEN or (
+            self.consecutive_failures >= p_config.router_failure_threshold
+        ):
+            if self.state != self.OPEN:
+                logger.warning(f"端点 {self.name} 熔断：{self.last_error}")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "endpoint": self.name,
+            "state": self.state,
+            "successes": self.successes,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "error_rate": round(self.error_rate, 3),
+            "latency": None if self.latency is None else round(self.latency, 3),
+            "last_error": self.last_error,
+        }
+
+
+class TokenBucket:
+    """按分钟补充的令牌桶，允许被实际用量扣成负数"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated) * self.capacity / 60,
+        )
+        self.updated = now
+
+    def take(self, n: float):
+        self.refill(time.monotonic())
+        self.tokens -= n
+
+    def level(self, now: float) -> float:
+        """剩余比例，0~1"""
+        self.refill(now)
+        return max(0.0, self.tokens / self.capacity)
+
+
+class KeyLimiter:
+    """单个 key 的限流状态：RPM/TPM 令牌桶、429 冷却与并发数"""
+
+    def __init__(self, rpm: float | None = None, tpm: float | None = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.cooldown_until = 0.0
+        self.in_flight = 0
+        self.used_tokens = 0
+
+    def ready(self, now: float) -> bool:
+        if now < self.cooldown_until:
+            return False
+        if self.requests and self.requests.level(now) * self.requests.capacity < 1:
+            return False
+        if self.tokens and self.tokens.level(now) <= 0:
+            return False
+        return True
+
+    def load(self, now: float) -> float:
+        """负载，越小越空闲"""
+        levels = [b.level(now) for b in (self.requests, self.tokens) if b]
+        return (1 - min(levels, default=1.0)) + self.in_flight
+
+    def acquire(self):
+        self.in_flight += 1
+        if self.requests:
+            self.requests.take(1)
+
+    def release(self):
+        self.in_flight = max(0, self.in_flight - 1)
+
+    def consume(self, tokens: int):
+        """按响应中的 usage 扣除令牌"""
+        self.used_tokens += tokens
+        if self.tokens:
+            self.tokens.take(tokens)
+
+    def throttle(self, seconds: float):
+        self.cooldown_until = max(self.cooldown_until, time.monotonic() + seconds)
+
+    def snapshot(self, now: float) -> dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "rpm_left": (
+                None
+                if not self.requests
+                else round(self.requests.level(now) * self.requests.capacity)
+            ),
+            "tpm_left": (
+                None
+                if not self.tokens
+                else round(self.tokens.level(now) * self.tokens.capacity)
+            ),
+            "cooldown": round(max(0.0, self.cooldown_until - now), 1),
+            "used_tokens": self.used_tokens,
+        }
+
+
+class Endpoint:
+    """一个可请求的目标：模型名 + 端点（key）配置"""
+
+    def __init__(
+        self,
+        model: str,
+        config: dict,
+        health: EndpointHealth,
+        limiter: KeyLimiter,
+        order: int = 0,
+    ):
+        self.model = model
+        self.config = config
+        self.health = health
+        self.limiter = limiter
+        self.order = order
+        """在故障转移链中的模型次序"""
+
+    @property
+    def key(self) -> tuple[str | None, str | None]:
+        return (self.config.get("base_url"), self.config.get("api_key"))
+
+
+class HedgeStats:
+    """对冲请求的统计：发出次数与对冲请求先返回的次数"""
+
+    def __init__(self):
+        self.fired = 0
+        self.won = 0
+
+    def snapshot(self) -> dict[str, Any]:
+        return {
+            "fired": self.fired,
+            "won": self.won,
+            "win_rate": round(self.won / self.fired, 3) if self.fired else None,
+        }
+
+
+class Router:
+    """在模型的多个 key/端点及其备选模型之间做负载均衡、重试与故障转移"""
+
+    def __init__(self, openai_config: dict[str, list[dict]]):
+        self.openai_config = openai_config
+        self.health: dict[tuple[str | None, str | None], EndpointHealth] = {}
+        self.limiters: dict[tuple[str | None, str | None], KeyLimiter] = {}
+        self.latencies: dict[tuple[str, bool], deque[float]] = {}
+        """(模型, 是否流式) -> 最近的成功请求延迟"""
+        self.hedges: dict[str, HedgeStats] = {}
+
+    def _state(self, config: dict) -> tuple[EndpointHealth, KeyLimiter]:
+        key = (config.get("base_url"), config.get("api_key"))
+        if key not in self.health:
+            api_key = str(key[1] or "")
+            self.health[key] = EndpointHealth(f"{key[0]} (…{api_key[-4:]})")
+            self.limiters[key] = KeyLimiter(config.get("rpm"), config.get("tpm"))
+        return self.health[key], self.limiters[key]
+
+    def chain(self, model: str) -> list[Endpoint]:
+        """模型自身的所有端点、keys.yaml 中的 fallbacks，最后是全局 fallback_model"""
+        names = [model]
+        for config in self.openai_config.get(model, []):
+            names += list(config.get("fallbacks") or [])
+        names.append(p_config.fallback_model)
+        ret: list[Endpoint] = []
+        seen: set[str] = set()
+        for name in names:
+            if name in seen or name not in self.openai_config:
+                continue
+            seen.add(name)
+            for config in self.openai_config[name]:
+                health, limiter = self._state(config)
+                ret.append(Endpoint(name, config, health, limiter, len(seen)))
+        return ret
+
+    def pick(self, chain: list[Endpoint], tried: set) -> Endpoint | None:
+        """
+        选择端点：排除熔断中的端点，优先本次未尝试过、未被限流的，
+        其次按故障转移次序，同一模型内选负载最低的 key
+        """
+        now = time.monotonic()
+        available = [e for e in chain if e.health.available(now)]
+        if not available:
+            return None
+        return min(
+            available,
+            key=lambda e: (
+                (e.model, e.key) in tried,
+                not e.limiter.ready(now),
+                e.order,
+                e.limiter.load(now),
+            ),
+        )
+
+    def record_latency(self, model: str, stream: bool, latency: float):
+        key = (model, stream)
+        if key not in self.latencies:
+            self.latencies[key] = deque(maxlen=p_config.hedge_window)
+        self.latencies[key].append(latency)
+
+    def hedge_delay(self, model: str, stream: bool) -> float | None:
+        """对冲等待时间：近期延迟的分位数，样本不足时不对冲"""
+        samples = self.latencies.get((model, stream))
+        if not samples or len(samples) < p_config.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * p_config.hedge_percentile))
+        return ordered[index]
+
+    def hedge_stats(self, model: str) -> HedgeStats:
+        if model not in self.hedges:
+            self.hedges[model] = HedgeStats()
+        return self.hedges[model]
+
+    @staticmethod
+    def backoff(attempt: int, ex: BaseException | None = None) -> float:
+        """带抖动的指数退避，若上游给出 Retry-After 则优先遵循"""
+        delay = min(
+            p_config.router_backoff_max, p_config.router_backoff_base * 2**attempt
+        )
+        delay = random.uniform(delay / 2, delay)
+        if ex is not None:
+            after = retry_after(ex)
+            if after is not None:
+                delay = min(max(delay, after), p_config.router_backoff_max)
+        return delay
+
+    def snapshot(self) -> list[dict[str, Any]]:
+        """导出所有端点的状态，供查看"""
+        now = time.monotonic()
+        models: dict[tuple, list[str]] = {}
+        for name, configs in self.openai_config.items():
+            for config in configs:
+                key = (config.get("base_url"), config.get("api_key"))
+                models.setdefault(key, []).append(name)
+        ret = []
+        for key, health in self.health.items():
+            data = health.snapshot()
+            data.update(self.limiters[key].snapshot(now))
+            data["models"] = models.get(key, [])
+            ret.append(data)
+        return ret
+
+    def hedge_snapshot(self) -> dict[str, dict[str, Any]]:
+        """各模型的对冲统计与当前对冲阈值"""
+        ret = {}
+        for model, stats in self.hedges.items():
+            data = stats.snapshot()
+            data["delay"] = self.hedge_delay(model, False)
+            data["stream_delay"] = self.hedge_delay(model, True)
+            ret[model] = data
+        return ret
@@ -0,0 +1,108 @@
+from abc import ABC, abstractmethod
+from typing import Any, Awaitable, Callable, TYPE_CHECKING
+from datetime import datetime
+
+from ..record import RecordSeg
+
+if TYPE_CHECKING:
+    from ..group import GroupRecord
+
+
+class Storage(ABC):
+    """
+    群聊天记录的持久化后端
+
+    保存的状态为 {"msgs": RecordList, "rest": int, "block_list": dict[str, datetime]}
+    """
+
+    @abstractmethod
+    def groups(self) -> list[str]:
+        """返回已保存的群号"""
+        pass
+
+    @abstractmethod
+    def load(self, group_id: str) -> dict[str, Any] | None:
+        """读取群的状态，没有保存过时返回 None"""
+        pass
+
+    @abstractmethod
+    def snapshot(
+        self, group_id: str, group: "GroupRecord"
+    ) -> Callable[[], Awaitable[None]] | None:
+        """
+        取出需要保存的内容（复制或与上次保存比较），没有变化时返回 None
+
+        在持有 group.lock 时同步调用；返回的协程函数执行实际写入，
+        调用方应在释放锁之后再调用它，同一个群的写入需依次进行
+        """
+        pass
+
+    async def save(self, group_id: str, group: "GroupRecord"):
+        """保存群的当前状态，调用方需持有 group.lock"""
+        write = self.snapshot(group_id, group)
+        if write is not None:
+            await write()
+
+    async def close(self):
+        """关闭时调用，确保数据落盘"""
+        pass
+
+
+def encode_record(record: RecordSeg) -> dict[str, Any]:
+    """把记录转换为可 JSON 序列化的字典"""
+    state = record.__getstate__()
+    state["time"] = record.time.isoformat()
+    if record.reply is not None:
+        state["reply"] = encode_record(record.reply)
+    return state
+
+
+def decode_record(state: dict[str, Any]) -> RecordSeg:
+    state = dict(state)
+    state["time"] = datetime.fromisoformat(state["time"])
+    state["msg"] = [tuple(m) for m in state.get("msg") or []]
+    if state.get("reply"):
+        state["reply"] = decode_record(state["reply"])
+    record = RecordSeg.__new__(RecordSeg)
+    record.__setstate__(state)
+    return record
+
+
+def encode_block_list(block_list: dict[str, datetime]) -> dict[str, str]:
+    return {k: v.isoformat() for k, v in block_list.items()}
+
+
+def decode_block_list(data: dict[str, str]) -> dict[str, datetime]:
+    return {k: datetime.fromisoformat(v) for k, v in data.items()}
+
+
+def create_storage(backend: str, root: str) -> Storage:
+    """
+    按名称创建持久化后端
+
+    Parameters:
+    -----------
+    backend: str
+        yaml：每次保存时重写整个 YAML 文件；
+        journal：只追加变更到日志，定期压缩为 YAML 快照；
+        sqlite：保存到 SQLite 数据库，首次使用时导入已有的 YAML 文件
+    root: str
+        数据目录
+    """
+    from ..config import p_config
+
+    if backend == "journal":
+        from .journal import JournalStorage
+
+        return JournalStorage(
+            root, p_config.journal_fsync_interval, p_config.journal_compact_ops
+        )
+    if backend == "sqlite":
+        from .sqlite import SqliteStorage
+
+        return SqliteStorage(root)
+    if backend != "yaml":
+        raise ValueError(f"Unknown storage backend: {backend}")
+    from .yaml_store import YamlStorage
+
+    return YamlStorage(root)
@@ -0,0 +1,290 @@
+import os
+import json
+import asyncio
+import pathlib
+
+from typing import Any, IO
+from functools import partial
+from nonebot import logger
+
+from . import (
+    Storage,
+    encode_record,
+    decode_record,
+    encode_block_list,
+    decode_block_list,
+)
+from .yaml_store import YamlStorage, group_state, dump_yaml
+from ..record import RecordSeg, RecordList
+
+
+class JournalStorage(Storage):
+    """
+    增量持久化：每次保存只把与上次保存的差异追加到 data/human/{群号}.journal，
+    日志条数达到 compact_ops 时把完整状态写为 YAML 快照并清空日志
+
+    日志每行为一个 JSON 数组 [序号, 操作, ...]：
+        ["del", [位置, ...]]   按上次保存时的位置删除记录
+        ["ins", 位置, 记录]    插入新记录
+        ["set", 位置, 记录]    替换被修改的记录（合并、撤回、图片变化等）
+        ["meta", {...}]        rest 与 block_list
+    快照中记录了已包含的最大序号，启动时先读快照，再重放之后的日志
+    """
+
+    def __init__(self, root: str, fsync_interval: float = 1.0, compact_ops: int = 500):
+        self.snapshots = YamlStorage(root)
+        self.root = self.snapshots.root
+        self.fsync_interval = fsync_interval
+        self.compact_ops = compact_ops
+        self.files: dict[str, IO[bytes]] = {}
+        self.persisted: dict[str, list[RecordSeg]] = {}
+        """上次保存时的记录，按对象身份比较差异"""
+        self.meta: dict[str, dict[str, Any]] = {}
+        self.seq: dict[str, int] = {}
+        self.ops: dict[str, int] = {}
+        """自上次快照以来的日志条数"""
+        self.unsynced: set[str] = set()
+        self.broken: set[str] = set()
+        """追加失败且未能截断的日志，尾部可能有不完整的行，下次保存直接写快照"""
+        self.flusher: asyncio.Task | None = None
+
+    def path(self, group_id: str) -> pathlib.Path:
+        return self.root / f"{group_id}.journal"
+
+    def groups(self) -> list[str]:
+        journals = {p.stem for p in self.root.glob("*.journal")}
+        return sorted(journals | set(self.snapshots.groups()))
+
+    def load(self, group_id: str) -> dict[str, Any] | None:
+        state = self.snapshots.load(group_id)
+        path = self.path(group_id)
+        if state is None and not path.exists():
+            return None
+        state = state or {}
+        msgs: RecordList = state.get("msgs") or RecordList()
+        records = list(msgs.records)
+        meta = {
+            "rest": state.get("rest", 100),
+            "block_list": encode_block_list(state.get("block_list") or {}),
+        }
+        seq = state.get("seq", 0)
+        ops = 0
+        if path.exists():
+            # 最后一条完整日志的结尾位置
+            good = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b"\n"):
+                            raise ValueError("missing newline")
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    good += len(line)
+                    if entry[0] <= seq:
+                        continue
+                    seq = entry[0]
+                    ops += 1
+                    self._apply(records, meta, entry[1], entry[2:])
+            if good < path.stat().st_size:
+                # 写入到一半时进程退出，截掉不完整的尾部，之后的日志才能追加在完整的行之后
+                logger.warning(f"{path} 末尾的日志不完整，已截断")
+                os.truncate(path, good)
+        msgs = RecordList(msgs.merge, records)
+        for r in msgs.records:
+            r._saved = True
+        self.persisted[group_id] = list(msgs.records)
+        self.meta[group_id] = meta
+        self.seq[group_id] = seq
+        self.ops[group_id] = ops
+        return {
+            "msgs": msgs,
+            "rest": meta["rest"],
+            "block_list": decode_block_list(meta["block_list"]),
+        }
+
+    @staticmethod
+    def _apply(records: list[RecordSeg], meta: dict, op: str, args: list):
+        if op == "del":
+            for index in reversed(args[0]):
+                del records[index]
+        elif op == "ins":
+            records.insert(args[0], decode_record(args[1]))
+        elif op == "set":
+            records[args[0]] = decode_record(args[1])
+        elif op == "meta":
+            meta.update(args[0])
+        else:
+            logger.warning(f"未知的日志操作: {op}")
+
+    def _diff(
+        self, group_id: str, group
+    ) -> tuple[list[RecordSeg], dict[str, Any], list[list]]:
+        """计算与上次保存的差异，返回 (当前记录, 当前 meta, 日志条目)，不修改已保存的状态"""
+        old = self.persisted.get(group_id, [])
+        current = list(group.msgs.records)
+        current_ids = {id(r) for r in current}
+        entries: list[list] = []
+        removed = [i for i, r in enumerate(old) if id(r) not in current_ids]
+        if removed:
+            entries.append(["del", removed])
+        # 记录不会被重新排序，保留下来的记录相对顺序不变
+        kept = {id(r) for r in old} & current_ids
+        for i, r in enumerate(current):
+            if id(r) not in kept:
+                entries.append(["ins", i, encode_record(r)])
+            elif not r._saved:
+                entries.append(["set", i, encode_record(r)])
+            r._saved = True
+        meta = {
+            "rest": group.rest,
+            "block_list": encode_block_list(group.block_list),
+        }
+        if meta != self.meta.get(group_id):
+            entries.append(["meta", meta])
+        return current, meta, entries
+
+    def _file(self, group_id: str) -> IO[bytes]:
+        f = self.files.get(group_id)
+        if f is None:
+            # 不使用缓冲，写入失败时没有残留在缓冲区中、之后才落盘的数据
+            f = open(self.path(group_id), "ab", buffering=0)
+            self.files[group_id] = f
+        return f
+
+    def _append(self, group_id: str, data: bytes):
+        """追加一批日志，失败时截断到写入前的位置，不留下半批日志"""
+        f = self._file(group_id)
+        pos = f.tell()
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[f.write(view) :]
+        except BaseException:
+            try:
+                f.truncate(pos)
+            except OSError:
+                self.files.pop(group_id, None)
+                f.close()
+                self.broken.add(group_id)
+            raise
+
+    def snapshot(self, group_id: str, group):
+        current, meta, entries = self._diff(group_id, group)
+        if not entries:
+            return None
+        seq = self.seq.get(group_id, 0)
+        lines = []
+        for entry in entries:
+            seq += 1
+            lines.append(
+                json.dumps([seq, *entry], ensure_ascii=False, separators=(",", ":"))
+                + "\n"
+            )
+        state = None
+        if (
+            group_id in self.broken
+            or self.ops.get(group_id, 0) + len(entries) >= self.compact_ops
+        ):
+            state = group_state(group_id, group, seq=seq)
+        return partial(
+            self._write,
+            group_id,
+            current,
+            meta,
+            seq,
+            "".join(lines).encode("utf-8"),
+            state,
+        )
+
+    async def _write(
+        self,
+        group_id: str,
+        current: list[RecordSeg],
+        meta: dict[str, Any],
+        seq: int,
+        data: bytes,
+        state: dict[str, Any] | None,
+    ):
+        # 日志尾部可能有不完整的行时不能再追加，直接写快照并清空日志
+        rewrite = group_id in self.broken and state is not None
+        try:
+            if rewrite:
+                await self._compact(group_id, state)  # type: ignore
+                self.broken.discard(group_id)
+            else:
+                self._append(group_id, data)
+        except BaseException:
+            # 写入失败时下次保存重写这些记录，persisted、meta 与 seq 保持不变
+            for r in current:
+                r._saved = False
+            raise
+        self.persisted[group_id] = current
+        self.meta[group_id] = meta
+        self.seq[group_id] = seq
+        if rewrite:
+            return
+        self.ops[group_id] = self.ops.get(group_id, 0) + data.count(b"\n")
+        if state is not None:
+            await self._compact(group_id, state)
+            return
+        self.unsynced.add(group_id)
+        if self.fsync_interval <= 0:
+            await self._sync()
+        elif self.flusher is None or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        # 把一段时间内的写入合并为一次 fsync
+        await asyncio.sleep(self.fsync_interval)
+        await self._sync()
+
+    async def _sync(self):
+        fds = []
+        for group_id in self.unsynced:
+            f = self.files.get(group_id)
+            if f is not None:
+                fds.append(f.fileno())
+        self.unsynced.clear()
+        await asyncio.to_thread(_fsync_all, fds)
+
+    async def compact(self, group_id: str, group):
+        """把当前状态写为快照并清空日志，调用方需持有 group.lock"""
+        await self._compact(
+            group_id, group_state(group_id, group, seq=self.seq.get(group_id, 0))
+        )
+
+    async def _compact(self, group_id: str, state: dict[str, Any]):
+        f = self.files.pop(group_id, None)
+        if f is not None:
+            f.close()
+        self.unsynced.discard(group_id)
+        await asyncio.to_thread(
+            _write_snapshot, self.snapshots.path(group_id), self.path(group_id), state
+        )
+        self.ops[group_id] = 0
+
+    async def close(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+        for f in self.files.values():
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        self.files.clear()
+        self.unsynced.clear()
+
+
+def _fsync_all(fds: list[int]):
+    for fd in fds:
+        try:
+            os.fsync(fd)
+        except OSError as ex:
+            # 文件可能已因压缩被关闭
+            logger.debug(f"fsync 失败: {ex}")
+
+
+def _write_snapshot(snapshot: pathlib.Path, journal: pathlib.Path, state: dict):
+    dump_yaml(snapshot, state)
+    # 快照中记录了序号，即使在这里中断，重放时也会跳过已包含的日志
+    open(journal, "w").close()
@@ -0,0 +1,291 @@
+import json
+import asyncio
+import pathlib
+import sqlite3
+
+from typing import Any, Callable
+from functools import partial
+from nonebot import logger
+from concurrent.futures import ThreadPoolExecutor
+
+from . import (
+    Storage,
+    encode_record,
+    decode_record,
+    encode_block_list,
+    decode_block_list,
+)
+from .yaml_store import YamlStorage
+from ..record import RecordSeg, RecordList
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS groups (
+    group_id TEXT PRIMARY KEY,
+    rest INTEGER NOT NULL,
+    credit REAL NOT NULL,
+    block_list TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    group_id TEXT NOT NULL,
+    pos REAL NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_group_pos ON records (group_id, pos);
+"""
+
+
+class SqliteStorage(Storage):
+    """
+    所有群保存在同一个 SQLite 数据库 data/human/human.db 中（WAL 模式）
+
+    每条记录一行，按 (group_id, pos) 索引；每次保存只删除、插入、更新有变化的行。
+    进程内只有一个连接，所有读写都在专用线程中执行，不阻塞事件循环。
+    首次打开时会导入目录中尚未导入的 YAML 文件
+    """
+
+    def __init__(self, root: str, name: str = "human.db"):
+        self.yaml = YamlStorage(root)
+        self.root = self.yaml.root
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="chatgpt-vision-sqlite"
+        )
+        self.conn: sqlite3.Connection | None = None
+        self.persisted: dict[str, list[tuple[RecordSeg, int, float]]] = {}
+        """上次保存时的 (记录, 行 ID, pos)，按对象身份比较差异"""
+        self.meta: dict[str, tuple] = {}
+        self._call(self._open, self.root / name)
+        self.import_yaml()
+
+    def _call(self, func: Callable, *args):
+        """在数据库线程中执行并等待结果，会阻塞调用方，不要在事件循环中直接调用"""
+        return self.executor.submit(func, *args).result()
+
+    async def _run(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def _open(self, path: pathlib.Path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def _groups(self) -> list[str]:
+        assert self.conn is not None
+        rows = self.conn.execute("SELECT group_id FROM groups ORDER BY group_id")
+        return [row[0] for row in rows]
+
+    def groups(self) -> list[str]:
+        return self._call(self._groups)
+
+    def import_yaml(self):
+        """导入尚未写入数据库的 data/human/*.yaml"""
+        existing = set(self.groups())
+        for group_id in self.yaml.groups():
+            if group_id in existing:
+                continue
+            state = self.yaml.load(group_id)
+            if state is None:
+                continue
+            records = [_dumps(r) for r in state["msgs"].records]
+            meta = (
+                state.get("rest", 100),
+                state.get("credit", 1),
+                encode_block_list(state.get("block_list") or {}),
+            )
+            self._call(self._import, group_id, records, meta)
+            logger.info(f"已将 {self.yaml.path(group_id)} 导入 SQLite")
+
+    def _import(self, group_id: str, records: list[str], meta: tuple):
+        assert self.conn is not None
+        with self.conn:
+            self._write_meta(group_id, meta)
+            self.conn.executemany(
+                "INSERT INTO records (group_id, pos, data) VALUES (?, ?, ?)",
+                [(group_id, float(i), data) for i, data in enumerate(records)],
+            )
+
+    def _load(self, group_id: str):
+        assert self.conn is not None
+        meta = self.conn.execute(
+            "SELECT rest, credit, block_list FROM groups WHERE group_id = ?",
+            (group_id,),
+        ).fetchone()
+        rows = self.conn.execute(
+            "SELECT id, pos, data FROM records WHERE group_id = ? ORDER BY pos, id",
+            (group_id,),
+        ).fetchall()
+        return meta, rows
+
+    def load(self, group_id: str) -> dict[str, Any] | None:
+        meta, rows = self._call(self._load, group_id)
+        if meta is None:
+            return None
+        rest, credit, block_list = meta
+        block_list = json.loads(block_list)
+        persisted = []
+        for rowid, pos, data in rows:
+            record = decode_record(json.loads(data))
+            record._saved = True
+            persisted.append((record, rowid, pos))
+        self.persisted[group_id] = persisted
+        self.meta[group_id] = (rest, credit, block_list)
+        return {
+            "msgs": RecordList(records=[r for r, _, _ in persisted]),
+            "rest": rest,
+            "credit": credit,
+            "block_list": decode_block_list(block_list),
+        }
+
+    def _diff(self, group_id: str, group):
+        """计算与上次保存的差异，返回 (当前记录, 各记录的 pos, 删除的行, 插入的行, 更新的行)"""
+        old = self.persisted.get(group_id, [])
+        current = list(group.msgs.records)
+        current_ids = {id(r) for r in current}
+        rows = {id(r): (rowid, pos) for r, rowid, pos in old}
+        removed = [rowid for r, rowid, _ in old if id(r) not in current_ids]
+        # 记录按时间排序且不会被重新排序，新记录的 pos 取前后两条保留记录的中间值
+        positions: list[float | None] = [
+            rows[id(r)][1] if id(r) in rows else None for r in current
+        ]
+        renumber = False
+        i = 0
+        while i < len(current):
+            if positions[i] is not None:
+                i += 1
+                continue
+            j = i
+            while j < len(current) and positions[j] is None:
+                j += 1
+            low = positions[i - 1] if i > 0 else None
+            high = positions[j] if j < len(current) else None
+            for k in range(i, j):
+                if low is None and high is None:
+                    positions[k] = float(k)
+                elif high is None:
+                    positions[k] = low + (k - i + 1)
+                elif low is None:
+                    positions[k] = high - (j - k)
+                else:
+                    positions[k] = low + (high - low) * (k - i + 1) / (j - i + 1)
+            if (low is not None and positions[i] <= low) or (
+                high is not None and positions[j - 1] >= high
+            ):
+                # 多次插入同一位置后浮点精度用尽，整体重新编号
+                renumber = True
+            i = j
+        if renumber:
+            positions = [float(k) for k in range(len(current))]
+        inserted: list[tuple[int, float, str]] = []
+        updated: list[tuple[int, float, str | None]] = []
+        for k, r in enumerate(current):
+            pos: float = positions[k]  # type: ignore
+            if id(r) not in rows:
+                inserted.append((k, pos, _dumps(r)))
+            elif not r._saved:
+                updated.append((rows[id(r)][0], pos, _dumps(r)))
+            elif renumber:
+                updated.append((rows[id(r)][0], pos, None))
+            r._saved = True
+        return current, positions, removed, inserted, updated
+
+    def _write_meta(self, group_id: str, meta: tuple):
+        assert self.conn is not None
+        rest, credit, block_list = meta
+        self.conn.execute(
+            "INSERT INTO groups (group_id, rest, credit, block_list) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (group_id) DO UPDATE SET "
+            "rest = excluded.rest, credit = excluded.credit, block_list = excluded.block_list",
+            (group_id, rest, credit, json.dumps(block_list)),
+        )
+
+    def _write(
+        self,
+        group_id: str,
+        meta: tuple | None,
+        removed: list[int],
+        inserted: list[tuple[int, float, str]],
+        updated: list[tuple[int, float, str | None]],
+    ) -> list[int]:
+        assert self.conn is not None
+        rowids = []
+        with self.conn:
+            if meta is not None:
+                self._write_meta(group_id, meta)
+            self.conn.executemany(
+                "DELETE FROM records WHERE id = ?", [(rowid,) for rowid in removed]
+            )
+            for rowid, pos, data in updated:
+                if data is None:
+                    self.conn.execute(
+                        "UPDATE records SET pos = ? WHERE id = ?", (pos, rowid)
+                    )
+                else:
+                    self.conn.execute(
+                        "UPDATE records SET pos = ?, data = ? WHERE id = ?",
+                        (pos, data, rowid),
+                    )
+            for _, pos, data in inserted:
+                cursor = self.conn.execute(
+                    "INSERT INTO records (group_id, pos, data) VALUES (?, ?, ?)",
+                    (group_id, pos, data),
+                )
+                rowids.append(cursor.lastrowid)
+        return rowids
+
+    def snapshot(self, group_id: str, group):
+        current, positions, removed, inserted, updated = self._diff(group_id, group)
+        meta = (
+            group.rest,
+            getattr(group, "credit", 1),
+            encode_block_list(group.block_list),
+        )
+        changed_meta = meta if meta != self.meta.get(group_id) else None
+        if not (changed_meta or removed or inserted or updated):
+            return None
+        return partial(
+            self._commit,
+            group_id,
+            current,
+            positions,
+            meta,
+            (group_id, changed_meta, removed, inserted, updated),
+        )
+
+    async def _commit(
+        self,
+        group_id: str,
+        current: list[RecordSeg],
+        positions: list,
+        meta: tuple,
+        changes: tuple,
+    ):
+        try:
+            rowids = await self._run(self._write, *changes)
+        except Exception:
+            # 写入失败时下次保存重写这些记录；新记录不在 persisted 中，会再次插入
+            for r in current:
+                r._saved = False
+            raise
+        inserted = changes[3]
+        self.meta[group_id] = meta
+        ids = {id(r): rowid for r, rowid, _ in self.persisted.get(group_id, [])}
+        for (k, _, _), rowid in zip(inserted, rowids):
+            ids[id(current[k])] = rowid
+        self.persisted[group_id] = [
+            (r, ids[id(r)], positions[k]) for k, r in enumerate(current)
+        ]
+
+    def _close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def close(self):
+        await self._run(self._close)
+        self.executor.shutdown()
+
+
+def _dumps(record: RecordSeg) -> str:
+    return json.dumps(encode_record(record), ensure_ascii=False)
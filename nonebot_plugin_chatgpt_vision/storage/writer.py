@@ -0,0 +1,86 @@
+import time
+import asyncio
+
+from typing import Mapping, TYPE_CHECKING
+from nonebot import logger
+
+from . import Storage
+
+if TYPE_CHECKING:
+    from ..group import GroupRecord
+
+
+class CoalescingWriter:
+    """
+    合并保存请求：mark_dirty 只把群标记为待保存，由后台任务写入，
+    每个群最多每 interval 秒写入一次，期间的多次修改合并为一次
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        groups: Mapping[str, "GroupRecord"],
+        interval: float = 5.0,
+    ):
+        self.storage = storage
+        self.groups = groups
+        self.interval = interval
+        self.dirty: set[str] = set()
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.last: dict[str, float] = {}
+        """每个群上次写入完成的时间（monotonic）"""
+        self.closing = False
+        self.wakeup = asyncio.Event()
+
+    def mark_dirty(self, group_id: str):
+        self.dirty.add(group_id)
+        if group_id not in self.tasks:
+            self.tasks[group_id] = asyncio.create_task(self._run(group_id))
+
+    async def _run(self, group_id: str):
+        try:
+            while group_id in self.dirty:
+                delay = self.last.get(group_id, float("-inf")) + self.interval
+                delay -= time.monotonic()
+                if delay > 0 and not self.closing:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                if not await self._save(group_id) and self.closing:
+                    break
+        finally:
+            # 在检查 dirty 之后同步移除，之后的 mark_dirty 一定会创建新任务
+            self.tasks.pop(group_id, None)
+
+    async def _save(self, group_id: str) -> bool:
+        self.dirty.discard(group_id)
+        group = self.groups[group_id]
+        try:
+            # 只在取快照时持有锁，写入时不阻塞群里的消息处理
+            async with group.lock:
+                write = self.storage.snapshot(group_id, group)
+            if write is not None:
+                await write()
+            return True
+        except Exception as ex:
+            # 保留标记，下一个间隔后重试
+            logger.error(f"保存群 {group_id} 的聊天记录失败: {ex}")
+            self.dirty.add(group_id)
+            return False
+        finally:
+            self.last[group_id] = time.monotonic()
+
+    async def flush(self):
+        """关闭时调用：立即写入所有待保存的群，不再等待间隔"""
+        # 不取消任务，正在进行的写入被打断会使存储的增量状态与文件不一致
+        self.closing = True
+        self.wakeup.set()
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks.values()), return_exceptions=True)
+        for group_id in list(self.dirty):
+            await self._save(group_id)
+
+    async def close(self):
+        await self.flush()
+        await self.storage.close()
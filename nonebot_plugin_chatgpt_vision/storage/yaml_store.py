@@ -0,0 +1,85 @@
+import os
+import yaml
+import asyncio
+import pathlib
+
+from typing import Any
+from functools import partial
+from nonebot import logger
+
+from . import Storage
+from ..record import RecordSeg, RecordList
+
+
+def copy_record(record: RecordSeg) -> RecordSeg:
+    """复制记录中会被原地修改的部分，供工作线程序列化"""
+    state = record.__getstate__()
+    state["msg"] = list(record.msg)
+    state["images"] = list(record.images)
+    if record.reply is not None:
+        state["reply"] = copy_record(record.reply)
+    copy = RecordSeg.__new__(RecordSeg)
+    copy.__setstate__(state)
+    return copy
+
+
+def group_state(group_id: str, group, **extra) -> dict[str, Any]:
+    """
+    YAML 文件中保存的内容
+
+    记录被复制，之后在其他线程中序列化时不受事件循环中的修改影响
+    """
+    msgs = RecordList(group.msgs.merge, map(copy_record, group.msgs.records))
+    return {
+        group_id: {
+            "msgs": msgs,
+            "rest": group.rest,
+            "block_list": dict(group.block_list),
+            # "credit": group.credit,
+            **extra,
+        }
+    }
+
+
+class YamlStorage(Storage):
+    """每个群一个 YAML 文件：data/human/{群号}.yaml"""
+
+    def __init__(self, root: str):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, group_id: str) -> pathlib.Path:
+        return self.root / f"{group_id}.yaml"
+
+    def groups(self) -> list[str]:
+        return sorted(p.stem for p in self.root.glob("*.yaml"))
+
+    def load(self, group_id: str) -> dict[str, Any] | None:
+        path = self.path(group_id)
+        if not path.exists():
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data: dict = yaml.load(f, yaml.UnsafeLoader)  # type: ignore
+        except Exception as ex:
+            logger.error(f"读取 {path} 失败: {ex}")
+            return None
+        state = (data or {}).get(group_id)
+        if state is None:
+            return None
+        state.setdefault("msgs", RecordList())
+        return state
+
+    def snapshot(self, group_id: str, group):
+        state = group_state(group_id, group)
+        return partial(asyncio.to_thread, dump_yaml, self.path(group_id), state)
+
+
+def dump_yaml(path: pathlib.Path, state: dict[str, Any]):
+    """序列化并原子地替换文件，中途退出不会留下写了一半的文件"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        yaml.dump(state, f, allow_unicode=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
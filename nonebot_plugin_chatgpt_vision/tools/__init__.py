@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import yaml
 import asyncio
 
@@ -14,6 +15,8 @@ from fastmcp.client.transports import (
     SSETransport,
 )
 
+from ..metrics import METRICS
+
 
 class Tool(ABC):
     @abstractmethod
@@ -88,11 +91,19 @@ class ToolManager:
         if name not in self.tools:
             logger.warning(f"Tool {name} not found")
             return f"工具 {name} 不存在"
+        start = time.monotonic()
+        status = "ok"
         try:
             return await self.tools[name].execute(**kwargs)
         except Exception as ex:
+            status = "error"
             logger.exception(f"Error executing tool {name}: {ex}")
             return f"执行工具 {name} 时出错: {ex}"
+        finally:
+            METRICS.inc("chatgpt_vision_tool_calls_total", tool=name, status=status)
+            METRICS.observe(
+                "chatgpt_vision_tool_seconds", time.monotonic() - start, tool=name
+            )
 
 
 class MCPUnifiedClient:
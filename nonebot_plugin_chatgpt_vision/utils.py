@@ -1,19 +1,36 @@
-import io
 import re
 import json
+import time
 import httpx
 import base64
+import asyncio
 import pathlib
-import cairosvg
 
-from PIL import Image
 from lxml import etree
-from nonebot import logger
+from nonebot import logger, get_driver
 from datetime import datetime, timedelta
+from collections import OrderedDict
 from urllib.parse import quote_plus, urlparse, parse_qs, urlencode, urlunparse
 from xml.sax.saxutils import escape as _xml_escape, quoteattr as _xml_q
 
 from .config import p_config
+from .client import get_http_client
+from .imaging import (
+    gif_to_png,
+    svg_to_png,
+    max_bytes,
+    dhash,
+    shrink_image,
+    read_limited,
+    run_image_task,
+)
+from .image_cache import (
+    IMAGE_CACHE,
+    image_phash,
+    image_identity,
+    remember_phash,
+    content_identity,
+)
 
 QFACE = {}
 try:
@@ -25,15 +42,45 @@ except Exception:
 GLOBAL_PROMPT = ""
 FORBIDDEN_TOOLS: set[str] = set()
 
+_CJK_RE = re.compile(
+    r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]"
+)
+_ENCODING: object | None = None
+""" tiktoken 编码器，None 表示尚未加载，False 表示不可用 """
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本的 token 数。安装了 tiktoken 时使用 o200k_base 编码，
+    否则按 CJK 字符约 1 token、其他字符约 4 个 1 token 估算
+    """
+    global _ENCODING
+    if not text:
+        return 0
+    if _ENCODING is None:
+        try:
+            import tiktoken  # type: ignore
+
+            _ENCODING = tiktoken.get_encoding("o200k_base")
+        except Exception:
+            _ENCODING = False
+    if _ENCODING:
+        return len(_ENCODING.encode(text, disallowed_special=()))  # type: ignore
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
 RKEY: dict[str, tuple[datetime, str]] = {
     "group": (datetime.min, ""),
     "private": (datetime.min, ""),
 }
+""" 由后台任务 rkey_refresher 定期刷新 """
+_RKEY_TASK: asyncio.Task | None = None
 
 
 def correct_tencent_image_url(url: str) -> str:
     """
-    修正腾讯图片 URL
+    修正腾讯图片 URL，替换为最新的 rkey（不会发出请求）
 
     Parameters:
     -----------
@@ -43,38 +90,125 @@ def correct_tencent_image_url(url: str) -> str:
     Returns:
     --------
     str
-        修正后的图片 URL
+        修正后的图片 URL，尚未获取到 rkey 时原样返回
     """
     if not url.startswith(
         ("https://multimedia.nt.qq.com.cn", "http://multimedia.nt.qq.com.cn")
     ):
         return url
-    if RKEY.get("group", (datetime.min, ""))[0] < datetime.now():
-        data = httpx.get("https://llob.linyuchen.net/rkey").json()
-        time = datetime.fromtimestamp(data.get("expired_time")) - timedelta(seconds=300)
-        RKEY["group"] = (time, data.get("group_rkey", "")[6:])
-        RKEY["private"] = (time, data.get("private_rkey", "")[6:])
+    rkey = RKEY.get("group", (None, ""))[1]
+    if not rkey:
+        return url
     parsed = urlparse(url)
     params = parse_qs(parsed.query)
-    params["rkey"] = [RKEY.get("group", (None, ""))[1]]
+    params["rkey"] = [rkey]
     return urlunparse(parsed._replace(query=urlencode(params, doseq=True)))
 
 
-async def convert_gif_to_png_base64(url: str) -> str:
+async def refresh_rkey() -> datetime:
+    """
+    从 rkey_url 获取最新的 rkey
+
+    Returns:
+    --------
+    datetime
+        需要再次刷新的时间（过期前 5 分钟）
+    """
+    async with httpx.AsyncClient(timeout=10) as client:
+        resp = await client.get(p_config.rkey_url)
+        resp.raise_for_status()
+        data = resp.json()
+    expire = datetime.fromtimestamp(data.get("expired_time")) - timedelta(seconds=300)
+    RKEY["group"] = (expire, data.get("group_rkey", "")[6:])
+    RKEY["private"] = (expire, data.get("private_rkey", "")[6:])
+    return expire
+
+
+async def rkey_refresher():
+    """在 rkey 过期前刷新，失败时退避重试"""
+    retry = 30.0
+    while True:
+        try:
+            expire = await refresh_rkey()
+            retry = 30.0
+            delay = (expire - datetime.now()).total_seconds()
+        except Exception as e:
+            logger.warning(f"刷新 rkey 失败: {e}")
+            delay, retry = retry, min(retry * 2, 600)
+        await asyncio.sleep(max(30.0, delay))
+
+
+async def start_rkey_refresher():
+    global _RKEY_TASK
+    if p_config.rkey_url and _RKEY_TASK is None:
+        _RKEY_TASK = asyncio.create_task(rkey_refresher())
+
+
+async def stop_rkey_refresher():
+    global _RKEY_TASK
+    if _RKEY_TASK is not None:
+        _RKEY_TASK.cancel()
+        _RKEY_TASK = None
+
+
+get_driver().on_startup(start_rkey_refresher)
+get_driver().on_shutdown(stop_rkey_refresher)
+
+
+_IMAGE_SEMAPHORE: asyncio.Semaphore | None = None
+
+
+def image_semaphore() -> asyncio.Semaphore:
+    """限制全局同时处理的图片数"""
+    global _IMAGE_SEMAPHORE
+    if _IMAGE_SEMAPHORE is None:
+        _IMAGE_SEMAPHORE = asyncio.Semaphore(max(1, p_config.image_concurrency))
+    return _IMAGE_SEMAPHORE
+
+
+async def _index_image(url: str, content: bytes | None = None):
+    """计算处理结果的感知哈希，用于窗口内的图片去重"""
+    if not p_config.image_dedup or image_phash(url) is not None:
+        return
+    try:
+        if content is None:
+            content = base64.b64decode(url.partition(",")[2])
+        remember_phash(url, await run_image_task(dhash, content))
+    except Exception as e:
+        logger.warning(f"计算图片哈希失败: {e}")
+
+
+async def convert_gif_to_png_base64(
+    url: str, client: httpx.AsyncClient | None = None
+) -> str:
     """
     检测并转换GIF图片为PNG格式的base64编码
 
     Args:
         url: 图片URL
+        client: 使用的 httpx 客户端，默认为共享客户端
 
     Returns:
         如果是GIF则返回转换后的base64 data URL，否则返回原URL
     """
+    async with image_semaphore():
+        # 能从链接识别出图片时，重复的表情包无需再下载
+        key = image_identity(url)
+        if key:
+            cached = await IMAGE_CACHE.get("png:" + key)
+            if cached is not None:
+                # 空字符串表示不是 GIF
+                if cached:
+                    await _index_image(cached)
+                return cached or url
+        return await _convert_gif_to_png_base64(url, client or get_http_client(), key)
+
+
+async def _convert_gif_to_png_base64(
+    url: str, client: httpx.AsyncClient, key: str | None
+) -> str:
     try:
-        async with (
-            httpx.AsyncClient(proxy=p_config.tool_proxy_url, timeout=10) as client,
-            client.stream("GET", url) as response,
-        ):
+        async with client.stream("GET", url) as response:
             response.raise_for_status()
             buffer = bytearray()
             aiter = response.aiter_bytes()
@@ -83,18 +217,24 @@ async def convert_gif_to_png_base64(url: str) -> str:
                 if len(buffer) >= 6:
                     break
             if not buffer.startswith(b"GIF"):
+                if key:
+                    await IMAGE_CACHE.set("png:" + key, "")
                 return url
-            async for chunk in aiter:
-                buffer.extend(chunk)
-            content = bytes(buffer)
-        with Image.open(io.BytesIO(content)) as img:
-            img = img.convert("RGBA")
-            output = io.BytesIO()
-            img.save(output, format="PNG")
-            output.seek(0)
-            png_data = output.getvalue()
+            content = await read_limited(response, max_bytes(), buffer, aiter)
+        # 相同内容只转换一次
+        content_key = "png:" + content_identity(content)
+        result = await IMAGE_CACHE.get(content_key)
+        if result is None:
+            png_data = await run_image_task(
+                gif_to_png, content, p_config.image_max_pixels
+            )
             base64_data = base64.b64encode(png_data).decode("utf-8")
-            return f"data:image/png;base64,{base64_data}"
+            result = f"data:image/png;base64,{base64_data}"
+            await IMAGE_CACHE.set(content_key, result)
+        await _index_image(result, content)
+        if key:
+            await IMAGE_CACHE.alias("png:" + key, content_key)
+        return result
 
     except Exception as e:
         logger.error(f"GIF转PNG失败: {e}")
@@ -103,21 +243,63 @@ async def convert_gif_to_png_base64(url: str) -> str:
     return url
 
 
+_URL_STATUS: OrderedDict[str, tuple[float, bool]] = OrderedDict()
+""" URL -> (过期时间, 是否可访问) """
+_URL_STATUS_SIZE = 8192
+_URL_PROBES: dict[str, asyncio.Future] = {}
+
+
 async def check_url_status(url: str, client: httpx.AsyncClient) -> str | None:
+    """
+    检查图片 URL 是否可访问，可访问时返回 URL，否则返回 None
+
+    结果缓存 image_check_ttl 秒（rkey 变化后 URL 不同，会重新检查），
+    并发检查同一 URL 时只发出一次请求
+    """
     if url.startswith("data:"):
         return url
+    cached = _URL_STATUS.get(url)
+    if cached and cached[0] > time.monotonic():
+        return url if cached[1] else None
+    probe = _URL_PROBES.get(url)
+    if probe is None:
+        probe = asyncio.ensure_future(_probe_url(url, client))
+        _URL_PROBES[url] = probe
+        probe.add_done_callback(lambda _: _URL_PROBES.pop(url, None))
+    # 某个等待者被取消时不影响其他等待者
+    return url if await asyncio.shield(probe) else None
+
+
+async def _probe_url(url: str, client: httpx.AsyncClient) -> bool:
+    ok = await _request_url_status(url, client)
+    if ok is None:
+        # 网络错误不缓存，下次重新检查
+        return False
+    ttl = p_config.image_check_ttl
+    if ttl > 0:
+        _URL_STATUS[url] = (time.monotonic() + ttl, ok)
+        _URL_STATUS.move_to_end(url)
+        while len(_URL_STATUS) > _URL_STATUS_SIZE:
+            _URL_STATUS.popitem(last=False)
+    return ok
+
+
+async def _request_url_status(url: str, client: httpx.AsyncClient) -> bool | None:
     try:
         async with client.stream("GET", url, timeout=5) as response:
             if response.status_code == 200:
-                return url
+                return True
             if response.status_code != 405:
                 logger.warning(
                     f"Image URL {url} returned status {response.status_code}"
                 )
-                return None
+                return False
         r = await client.head(url, timeout=5)
         r.raise_for_status()
-        return url
+        return True
+    except httpx.HTTPStatusError as e:
+        logger.warning(f"Image URL {url} returned status {e.response.status_code}")
+        return False
     except Exception as e:
         logger.error(f"检查图片URL状态失败: {e}")
         return None
@@ -133,29 +315,88 @@ async def download_image_to_base64(url: str, client: httpx.AsyncClient) -> str:
     Returns:
         base64编码的data URL
     """
+    key = image_identity(url)
+    if key:
+        cached = await IMAGE_CACHE.get("b64:" + key)
+        if cached is not None:
+            return cached
     try:
-        resp = await client.get(url, timeout=10)
-        resp.raise_for_status()
-        content_type = resp.headers.get("Content-Type", "image/png")
-        base64_data = base64.b64encode(resp.content).decode("utf-8")
-        return f"data:{content_type};base64,{base64_data}"
+        async with client.stream("GET", url, timeout=10) as resp:
+            resp.raise_for_status()
+            content_type = resp.headers.get("Content-Type", "image/png")
+            content = await read_limited(resp, max_bytes())
+        base64_data = base64.b64encode(content).decode("utf-8")
+        result = f"data:{content_type};base64,{base64_data}"
+        if key:
+            await IMAGE_CACHE.set("b64:" + key, result)
+        return result
     except Exception as e:
         logger.error(f"图片下载失败: {e}")
     return url
 
 
+async def prepare_image(url: str, client: httpx.AsyncClient) -> str:
+    """
+    把图片缩放、重新编码为发给模型的 data URL，结果按图片缓存
+
+    Args:
+        url: 图片URL 或 data URL，前者会先下载
+
+    Returns:
+        处理后的 data URL，失败时返回原值
+    """
+    edge = p_config.image_max_edge
+    if edge <= 0:
+        if url.startswith("data:"):
+            return url
+        return await download_image_to_base64(url, client)
+    fmt, quality = p_config.image_format, p_config.image_quality
+    prefix = f"prep:{edge}:{fmt}:{quality}:"
+    async with image_semaphore():
+        key = None
+        try:
+            if url.startswith("data:"):
+                content = base64.b64decode(url.partition(",")[2])
+            else:
+                key = image_identity(url)
+                if key:
+                    cached = await IMAGE_CACHE.get(prefix + key)
+                    if cached is not None:
+                        await _index_image(cached)
+                        return cached
+                async with client.stream("GET", url, timeout=10) as resp:
+                    resp.raise_for_status()
+                    content = await read_limited(resp, max_bytes())
+            content_key = prefix + content_identity(content)
+            result = await IMAGE_CACHE.get(content_key)
+            if result is None:
+                data, mime = await run_image_task(
+                    shrink_image,
+                    content,
+                    edge,
+                    fmt,
+                    quality,
+                    p_config.image_max_pixels,
+                )
+                result = f"data:{mime};base64,{base64.b64encode(data).decode()}"
+                await IMAGE_CACHE.set(content_key, result)
+            await _index_image(result)
+            if key:
+                await IMAGE_CACHE.alias(prefix + key, content_key)
+            return result
+        except Exception as e:
+            logger.error(f"图片预处理失败: {e}")
+            return url
+
+
 async def convert_tex_to_png(tex: str, client: httpx.AsyncClient) -> bytes | None:
     try:
-        resp = await client.get(
-            "https://www.zhihu.com/equation?tex=" + quote_plus(tex), timeout=10
-        )  # or "https://math.now.sh?from=" + quote_plus(tex)
-        resp.raise_for_status()
-        png_data = cairosvg.svg2png(
-            bytestring=resp.text.encode("utf-8"),
-            scale=2,
-            background_color="#FFFBE6",
-        )
-        return png_data
+        async with client.stream(
+            "GET", "https://www.zhihu.com/equation?tex=" + quote_plus(tex), timeout=10
+        ) as resp:  # or "https://math.now.sh?from=" + quote_plus(tex)
+            resp.raise_for_status()
+            svg = await read_limited(resp, max_bytes())
+        return await run_image_task(svg_to_png, svg, p_config.image_max_pixels)
     except Exception as e:
         logger.error(f"公式渲染失败: {e}")
         return None
@@ -532,3 +773,71 @@ def fix_xml(xml: str, convert_face_to_image=True) -> str:
     parser.feed(xml)
     parser.feed("</root>")
     return parser.close()  # type: ignore
+
+
+class ParagraphStream:
+    """
+    把流式输出的“类 XML”按顶层 <p> 切分，段落一闭合就产出原始片段，
+    片段本身仍需交给 fix_xml 规约。CDATA 内的 </p> 不会被当作段落结束。
+    """
+
+    _P_TAG_RE = re.compile(r"<(/?)p(?:\s[^>]*)?(/?)>", re.I)
+    _CDATA = "<![CDATA["
+
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_cdata = False
+
+    def feed(self, text: str) -> list[str]:
+        """追加一段增量文本，返回本次已闭合的段落"""
+        self.buf += text
+        out: list[str] = []
+        while True:
+            if self.in_cdata:
+                i = self.buf.find("]]>", self.pos)
+                if i < 0:
+                    self.pos = max(self.pos, len(self.buf) - 2)
+                    break
+                self.in_cdata = False
+                self.pos = i + 3
+                continue
+            i = self.buf.find("<", self.pos)
+            if i < 0:
+                self.pos = len(self.buf)
+                break
+            head = self.buf[i : i + len(self._CDATA)]
+            if head == self._CDATA:
+                self.in_cdata = True
+                self.pos = i + len(self._CDATA)
+                continue
+            if self._CDATA.startswith(head):
+                # 可能是尚未接收完整的 CDATA 起始标记
+                self.pos = i
+                break
+            j = self.buf.find(">", i)
+            if j < 0:
+                self.pos = i
+                break
+            self.pos = j + 1
+            m = self._P_TAG_RE.fullmatch(self.buf, i, j + 1)
+            if not m or m.group(2):
+                continue
+            if not m.group(1):
+                self.depth += 1
+                continue
+            if self.depth == 0:
+                continue
+            self.depth -= 1
+            if self.depth == 0:
+                out.append(self.buf[: j + 1])
+                self.buf = self.buf[j + 1 :]
+                self.pos = 0
+        return out
+
+    def close(self) -> str:
+        """返回尚未闭合的剩余内容"""
+        rest, self.buf, self.pos, self.depth = self.buf, "", 0, 0
+        self.in_cdata = False
+        return rest if rest.strip() else ""